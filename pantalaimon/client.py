@@ -13,20 +13,27 @@
 # limitations under the License.
 
 import asyncio
+import hashlib
 import os
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager, nullcontext
 from pprint import pformat
-from typing import Any, Dict, Optional
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
 from urllib.parse import urlparse
 
+import attr
 from aiohttp.client_exceptions import ClientConnectionError
+from cachetools import LRUCache
 from jsonschema import Draft4Validator, FormatChecker, validators
+from olm import InboundGroupSession as OlmInboundGroupSession
+from olm import OlmGroupSessionError
 from playhouse.sqliteq import SqliteQueueDatabase
 from nio import (
     AsyncClient,
     AsyncClientConfig,
     EncryptionError,
     Event,
+    ForwardedRoomKeyEvent,
     ToDeviceEvent,
     KeysQueryResponse,
     KeyVerificationEvent,
@@ -45,15 +52,22 @@ from nio import (
     RoomNameEvent,
     RoomTopicEvent,
     RoomKeyRequest,
+    RoomKeyEvent,
     RoomKeyRequestCancellation,
     SyncResponse,
 )
-from nio.crypto import Sas
+from nio.crypto import Olm, Sas
 from nio.store import SqliteStore
 
+from pantalaimon.codec import dumps_bytes
 from pantalaimon.index import INDEXING_ENABLED
 from pantalaimon.log import logger
-from pantalaimon.store import FetchTask, MediaInfo
+from pantalaimon.store import (
+    BatchedSqliteStore,
+    FetchTask,
+    MediaInfo,
+    profiled_store_class,
+)
 from pantalaimon.thread_messages import (
     DaemonResponse,
     InviteSasSignal,
@@ -67,6 +81,15 @@ from pantalaimon.thread_messages import (
 
 SEARCH_KEYS = ["content.body", "content.name", "content.topic"]
 
+# The number of to-device events that are remembered, so events that arrive on
+# the sync streams of the client and of the background sync client are only
+# handled once.
+HANDLED_TO_DEVICE_EVENTS = 10000
+
+# The number of responses of the sync loop that are kept around for clients
+# that share the sync stream of their account.
+SYNC_STREAM_SIZE = 10
+
 SEARCH_TERMS_SCHEMA = {
     "type": "object",
     "properties": {
@@ -132,6 +155,204 @@ class InvalidLimit(Exception):
     pass
 
 
+def decrypt_megolm_ciphertexts(jobs):
+    """Decrypt a batch of megolm ciphertexts.
+
+    This runs in a worker thread. The worker gets pickles of the sessions
+    instead of the sessions themselves and decrypts with private copies of
+    them, so it never uses a libolm object that the event loop might be using
+    at the same time.
+
+    Args:
+        jobs (List[Tuple[bytes, str]]): The pickled sessions and the
+            ciphertexts that should be decrypted with them.
+
+    Returns a list containing the (plaintext, message_index) tuple, or the
+    OlmGroupSessionError that was raised, for every job.
+    """
+    sessions = {}
+    results = []
+
+    for pickle, ciphertext in jobs:
+        session = sessions.get(pickle)
+
+        if not session:
+            session = OlmInboundGroupSession.from_pickle(pickle)
+            sessions[pickle] = session
+
+        try:
+            results.append(session.decrypt(ciphertext))
+        except OlmGroupSessionError as e:
+            results.append(e)
+
+    return results
+
+
+def to_device_event_key(event_dict):
+    # type: (Dict[Any, Any]) -> str
+    """Get a key that identifies a to-device event.
+
+    To-device events don't have an event id, the key is a hash over the
+    sender, type and content of the event.
+    """
+    event = [
+        event_dict.get("sender"),
+        event_dict.get("type"),
+        event_dict.get("content"),
+    ]
+    return hashlib.sha256(dumps_bytes(event, sort_keys=True)).hexdigest()
+
+
+def plaintext_size(result):
+    """Get the size of a cached (plaintext, message_index) tuple."""
+    plaintext, _ = result
+    return len(plaintext)
+
+
+@attr.s
+class SyncStream:
+    """The recent responses of the sync loop of a PanClient.
+
+    Clients of the account can be served from these responses instead of
+    running their own sync requests against the homeserver. The responses are
+    stored as the raw bodies the homeserver sent, keyed by the since token of
+    the request that returned them.
+
+    Args:
+        maxsize (int): The number of responses that are kept.
+    """
+
+    maxsize = attr.ib(type=int, default=SYNC_STREAM_SIZE)
+    responses = attr.ib(init=False, factory=OrderedDict)
+    next_batch = attr.ib(type=str, init=False, default=None)
+    updated = attr.ib(init=False, factory=asyncio.Event)
+    timed_out = attr.ib(init=False, factory=set)
+
+    def add(self, since, next_batch, body):
+        # type: (Optional[str], str, Optional[bytes]) -> None
+        """Add a response of the sync loop to the stream.
+
+        Args:
+            since (str, optional): The since token of the sync request.
+            next_batch (str): The next_batch token of the response.
+            body (bytes, optional): The raw body of the response, None if the
+                response shouldn't be handed out to clients.
+        """
+        if since and body is not None:
+            self.responses[since] = body
+            self.responses.move_to_end(since)
+
+            while len(self.responses) > self.maxsize:
+                self.responses.popitem(last=False)
+
+        self.next_batch = next_batch
+        self.timed_out.clear()
+
+        self.updated.set()
+        self.updated = asyncio.Event()
+
+    async def get(self, since, timeout):
+        # type: (str, float) -> Optional[bytes]
+        """Get the response that continues the stream from a since token.
+
+        If the token is the one of the sync request that is currently running
+        the response is awaited for at most timeout seconds. An empty sync
+        response is returned if it doesn't arrive in time. If the sync loop
+        still hasn't answered the next time the token is requested, the
+        request isn't served from the stream anymore, so a stalled sync loop
+        doesn't leave clients with empty responses.
+
+        Returns None if the request can't be served from the stream.
+        """
+        body = self.responses.get(since)
+
+        if body is not None:
+            return body
+
+        if not since or since != self.next_batch or since in self.timed_out:
+            return None
+
+        try:
+            await asyncio.wait_for(self.updated.wait(), timeout)
+        except asyncio.TimeoutError:
+            self.timed_out.add(since)
+            return dumps_bytes({"next_batch": since})
+
+        return self.responses.get(since)
+
+
+@attr.s
+class DecryptedSession:
+    """An inbound group session that knows the plaintext of a ciphertext.
+
+    The plaintext either comes from a worker thread or from the decrypted
+    event cache, otherwise the ciphertext is decrypted by the session and the
+    result is remembered. All other attributes come from the wrapped session.
+
+    Args:
+        session (InboundGroupSession): The session of the event.
+        ciphertext (str): The ciphertext of the event.
+        result (Union[Tuple[str, int], OlmGroupSessionError], optional): The
+            plaintext and message index of the ciphertext, or the error that
+            decrypting it raised.
+    """
+
+    session = attr.ib()
+    ciphertext = attr.ib(type=str)
+    result = attr.ib(default=None)
+
+    def decrypt(self, ciphertext):
+        if ciphertext != self.ciphertext:
+            return self.session.decrypt(ciphertext)
+
+        if self.result is None:
+            try:
+                self.result = self.session.decrypt(ciphertext)
+            except OlmGroupSessionError as e:
+                self.result = e
+
+        if isinstance(self.result, OlmGroupSessionError):
+            raise self.result
+
+        return self.result
+
+    def __getattr__(self, name):
+        if name == "session":
+            raise AttributeError(name)
+
+        return getattr(self.session, name)
+
+
+class DecryptedSessionOlm:
+    """A view of an Olm machine that decrypts a single event.
+
+    This lets nio's Olm.decrypt_megolm_event() run all of its checks, replay
+    protection, device verification and payload validation, on an event
+    whose ciphertext was decrypted elsewhere. Olm.decrypt_megolm_event()
+    looks the session of the event up in its inbound_group_store, the view
+    answers that lookup with a DecryptedSession, every other attribute is the
+    one of the real Olm machine. This depends on how nio 0.20 looks up the
+    session, check it when the nio dependency is bumped.
+    """
+
+    def __init__(self, olm, session):
+        self.olm = olm
+        self.session = session
+
+    @property
+    def inbound_group_store(self):
+        return self
+
+    def get(self, room_id, sender_key, session_id):
+        return self.session
+
+    def __getattr__(self, name):
+        if name == "olm":
+            raise AttributeError(name)
+
+        return getattr(self.olm, name)
+
+
 class SqliteQStore(SqliteStore):
     def _create_database(self):
         return SqliteQueueDatabase(
@@ -160,9 +381,13 @@ class PanClient(AsyncClient):
         proxy=None,
         store_class=None,
         media_info=None,
+        decryption_pool=None,
     ):
         config = config or AsyncClientConfig(
-            store=store_class or SqliteStore, store_name="pan.db"
+            store=profiled_store_class(
+                store_class or BatchedSqliteStore, pan_conf.storage_profile
+            ),
+            store_name="pan.db",
         )
         super().__init__(homeserver, user_id, device_id, store_path, config, ssl, proxy)
 
@@ -177,12 +402,22 @@ class PanClient(AsyncClient):
         self.pan_store = pan_store
         self.pan_conf = pan_conf
         self.media_info = media_info
+        self.decryption_pool = decryption_pool
+
+        # The decrypted payloads of megolm events, shared between all the
+        # clients that sync or paginate through this account.
+        self.decrypted_events = LRUCache(
+            pan_conf.decrypted_event_cache_size * 1024 * 1024,
+            getsizeof=plaintext_size,
+        )
 
         if INDEXING_ENABLED:
             logger.info("Indexing enabled.")
             from pantalaimon.index import IndexStore
 
-            self.index = IndexStore(self.user_id, index_dir)
+            self.index = IndexStore(
+                self.user_id, index_dir, storage_profile=pan_conf.storage_profile
+            )
         else:
             logger.info("Indexing disabled.")
             self.index = None
@@ -194,6 +429,10 @@ class PanClient(AsyncClient):
         self.new_fetch_task = asyncio.Event()
         self.fetch_loop_event = asyncio.Event()
 
+        # The responses of our sync loop, clients of this account are served
+        # from it if sync multiplexing is enabled.
+        self.sync_stream = SyncStream() if pan_conf.sync_multiplexing else None
+
         self.room_members_fetched = defaultdict(bool)
 
         self.send_semaphores = defaultdict(asyncio.Semaphore)
@@ -203,7 +442,17 @@ class PanClient(AsyncClient):
         self.history_fetcher_task = None
         self.history_fetch_queue = asyncio.Queue()
 
+        # The keys of the to-device events that were already handled.
+        self.handled_to_device_events = LRUCache(HANDLED_TO_DEVICE_EVENTS)
+
+        # Futures of the decryption attempts that wait for a room key, keyed
+        # by the room id and session id of the key.
+        self.room_key_waiters = defaultdict(list)
+
         self.add_to_device_callback(self.key_verification_cb, KeyVerificationEvent)
+        self.add_to_device_callback(
+            self.room_key_cb, (RoomKeyEvent, ForwardedRoomKeyEvent)
+        )
         self.add_to_device_callback(
             self.key_request_cb, (RoomKeyRequest, RoomKeyRequestCancellation)
         )
@@ -330,13 +579,19 @@ class PanClient(AsyncClient):
         """Send a single device to the UI thread to be updated."""
         await self.send_update_devices({device.user_id: {device.id: device}})
 
-    def delete_fetcher_task(self, task):
-        self.pan_store.delete_fetcher_task(self.server_name, self.user_id, task)
+    async def delete_fetcher_task(self, task):
+        await self.pan_store.aio.delete_fetcher_task(
+            self.server_name, self.user_id, task
+        )
 
     async def fetcher_loop(self):
         assert INDEXING_ENABLED
 
-        for t in self.pan_store.load_fetcher_tasks(self.server_name, self.user_id):
+        tasks = await self.pan_store.aio.load_fetcher_tasks(
+            self.server_name, self.user_id
+        )
+
+        for t in tasks:
             await self.history_fetch_queue.put(t)
 
         while True:
@@ -352,7 +607,7 @@ class PanClient(AsyncClient):
                 except KeyError:
                     # The room is missing from our client, we probably left the
                     # room.
-                    self.delete_fetcher_task(fetch_task)
+                    await self.delete_fetcher_task(fetch_task)
                     continue
 
                 try:
@@ -371,7 +626,7 @@ class PanClient(AsyncClient):
 
                 # The chunk was empty, we're at the start of the timeline.
                 if not response.chunk:
-                    self.delete_fetcher_task(fetch_task)
+                    await self.delete_fetcher_task(fetch_task)
                     continue
 
                 for event in response.chunk:
@@ -397,7 +652,7 @@ class PanClient(AsyncClient):
                     # There may be even more events to fetch, add a new task to
                     # the queue.
                     task = FetchTask(room.room_id, response.end)
-                    self.pan_store.replace_fetcher_task(
+                    await self.pan_store.aio.replace_fetcher_task(
                         self.server_name, self.user_id, fetch_task, task
                     )
                     await self.history_fetch_queue.put(task)
@@ -405,11 +660,32 @@ class PanClient(AsyncClient):
                     self.new_fetch_task.clear()
                 else:
                     await self.index.commit_events()
-                    self.delete_fetcher_task(fetch_task)
+                    await self.delete_fetcher_task(fetch_task)
 
             except (asyncio.CancelledError, KeyboardInterrupt):
                 return
 
+    async def create_matrix_response(
+        self, response_class, transport_response, data=None
+    ):
+        response = await super().create_matrix_response(
+            response_class, transport_response, data
+        )
+
+        if self.sync_stream is not None and isinstance(response, SyncResponse):
+            query = transport_response.url.query
+
+            # Responses to full state requests contain more than a client
+            # that continues its sync stream expects.
+            if query.get("full_state") == "true":
+                body = None
+            else:
+                body = await transport_response.read()
+
+            self.sync_stream.add(query.get("since"), response.next_batch, body)
+
+        return response
+
     @property
     def has_been_synced(self) -> bool:
         self.last_sync_token is not None
@@ -437,7 +713,9 @@ class PanClient(AsyncClient):
                     "room for history fetching.".format(room.display_name)
                 )
                 task = FetchTask(room_id, room_info.timeline.prev_batch)
-                self.pan_store.save_fetcher_task(self.server_name, self.user_id, task)
+                await self.pan_store.aio.save_fetcher_task(
+                    self.server_name, self.user_id, task
+                )
 
                 await self.history_fetch_queue.put(task)
                 self.new_fetch_task.set()
@@ -463,6 +741,74 @@ class PanClient(AsyncClient):
             except ClientConnectionError:
                 pass
 
+    def room_key_cb(self, event):
+        self.room_key_received(event.room_id, event.session_id)
+
+    def room_key_received(self, room_id, session_id):
+        """Wake up the decryption attempts that wait for a room key."""
+        for waiter in self.room_key_waiters.pop((room_id, session_id), []):
+            if not waiter.done():
+                waiter.set_result(None)
+
+    @contextmanager
+    def watch_room_keys(self, sessions):
+        # type: (Set[Tuple[str, str]]) -> Iterator[Dict[Tuple[str, str], Any]]
+        """Register futures that are resolved when the given room keys arrive.
+
+        The futures are registered when the context is entered, so keys that
+        arrive while the caller is busy aren't missed. They are removed when
+        the context is left.
+
+        Args:
+            sessions (Set[Tuple[str, str]]): The room id and session id pairs
+                of the room keys.
+
+        Yields a dictionary mapping the room id and session id pairs to their
+        futures.
+        """
+        loop = asyncio.get_event_loop()
+        waiters = {}
+
+        for key in sessions:
+            waiter = loop.create_future()
+            self.room_key_waiters[key].append(waiter)
+            waiters[key] = waiter
+
+        try:
+            yield waiters
+        finally:
+            for key, waiter in waiters.items():
+                waiter.cancel()
+
+                key_waiters = self.room_key_waiters.get(key)
+
+                if key_waiters and waiter in key_waiters:
+                    key_waiters.remove(waiter)
+
+                    if not key_waiters:
+                        del self.room_key_waiters[key]
+
+    async def wait_for_room_keys(self, sessions, timeout):
+        # type: (Set[Tuple[str, str]], float) -> bool
+        """Wait until one of the given room keys arrives.
+
+        Args:
+            sessions (Set[Tuple[str, str]]): The room id and session id pairs
+                of the missing room keys.
+            timeout (float): The number of seconds to wait at most.
+
+        Returns True if a room key arrived, False if the wait timed out.
+        """
+        if not sessions:
+            return False
+
+        with self.watch_room_keys(sessions) as waiters:
+            done, _ = await asyncio.wait(
+                waiters.values(), timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+            )
+
+        return bool(done)
+
     async def key_request_cb(self, event):
         if isinstance(event, RoomKeyRequest):
             logger.info(
@@ -542,7 +888,14 @@ class PanClient(AsyncClient):
             self.history_fetcher_task = loop.create_task(self.fetcher_loop())
 
         timeout = 30000
-        sync_filter = {"room": {"state": {"lazy_load_members": True}}}
+
+        # The responses are handed out to clients that didn't ask for lazy
+        # loading if the sync stream is shared.
+        if self.sync_stream:
+            sync_filter = None
+        else:
+            sync_filter = {"room": {"state": {"lazy_load_members": True}}}
+
         next_batch = self.pan_store.load_token(self.server_name, self.user_id)
 
         # We don't store any room state so initial sync needs to be with the
@@ -805,8 +1158,8 @@ class PanClient(AsyncClient):
 
         self.history_fetch_queue = asyncio.Queue()
 
-    def pan_decrypt_event(self, event_dict, room_id=None, ignore_failures=True):
-        # type: (Dict[Any, Any], Optional[str], bool) -> (bool)
+    def _parse_megolm_event(self, event_dict, room_id=None):
+        # type: (Dict[Any, Any], Optional[str]) -> Optional[MegolmEvent]
         event = Event.parse_encrypted_event(event_dict)
 
         if not isinstance(event, MegolmEvent):
@@ -814,49 +1167,201 @@ class PanClient(AsyncClient):
                 "Encrypted event is not a megolm event:"
                 "\n{}".format(pformat(event_dict))
             )
-            return False
+            return None
 
         if not event.room_id:
             event.room_id = room_id
 
-        try:
-            decrypted_event = self.decrypt_event(event)
-            logger.debug("Decrypted event: {}".format(decrypted_event))
-            logger.info(
-                "Decrypted event from {} in {}, event id: {}".format(
-                    decrypted_event.sender,
-                    decrypted_event.room_id,
-                    decrypted_event.event_id,
-                )
+        return event
+
+    def _replace_decrypted_event(self, event_dict, decrypted_event):
+        # type: (Dict[Any, Any], Event) -> None
+        logger.debug("Decrypted event: {}".format(decrypted_event))
+        logger.info(
+            "Decrypted event from {} in {}, event id: {}".format(
+                decrypted_event.sender,
+                decrypted_event.room_id,
+                decrypted_event.event_id,
             )
+        )
+
+        if isinstance(decrypted_event, RoomEncryptedMedia):
+            self.store_event_media(decrypted_event)
 
-            if isinstance(decrypted_event, RoomEncryptedMedia):
-                self.store_event_media(decrypted_event)
+            decrypted_event.source["content"]["url"] = decrypted_event.url
 
-                decrypted_event.source["content"]["url"] = decrypted_event.url
+            if decrypted_event.thumbnail_url:
+                decrypted_event.source["content"]["info"][
+                    "thumbnail_url"
+                ] = decrypted_event.thumbnail_url
+
+        event_dict.update(decrypted_event.source)
+        event_dict["decrypted"] = True
+        event_dict["verified"] = decrypted_event.verified
+
+    def _decryption_failed(self, event_dict, error, ignore_failures):
+        # type: (Dict[Any, Any], EncryptionError, bool) -> None
+        logger.warn(error)
+
+        if ignore_failures:
+            event_dict.update(self.unable_to_decrypt)
+        else:
+            raise error
 
-                if decrypted_event.thumbnail_url:
-                    decrypted_event.source["content"]["info"][
-                        "thumbnail_url"
-                    ] = decrypted_event.thumbnail_url
+    def _decrypted_event_key(self, event):
+        # type: (MegolmEvent) -> Optional[Tuple[str, str, str, str]]
+        if not event.event_id:
+            return None
 
-            event_dict.update(decrypted_event.source)
-            event_dict["decrypted"] = True
-            event_dict["verified"] = decrypted_event.verified
+        # The key covers the ciphertext as well, all the other parts come
+        # from the homeserver and a changed ciphertext needs to be decrypted
+        # again.
+        ciphertext_hash = hashlib.sha256(event.ciphertext.encode()).hexdigest()
 
-            return True
+        return (event.room_id, event.event_id, event.session_id, ciphertext_hash)
 
+    def _decrypt_with_session(self, event_dict, event, session, ignore_failures):
+        """Decrypt an event using nio with the given decrypted session.
+
+        Args:
+            event_dict (Dict[Any, Any]): The encrypted event that will be
+                replaced with the decrypted one.
+            event (MegolmEvent): The parsed encrypted event.
+            session (DecryptedSession): The session of the event, it might
+                already know the plaintext of the event.
+            ignore_failures (bool): Should a failure replace the event with an
+                error message, otherwise the error is raised.
+
+        Returns True if the event was decrypted, False otherwise.
+        """
+        try:
+            decrypted_event = Olm.decrypt_megolm_event(
+                DecryptedSessionOlm(self.olm, session), event
+            )
         except EncryptionError as error:
-            logger.warn(error)
+            self._decryption_failed(event_dict, error, ignore_failures)
+            return False
 
-            if ignore_failures:
-                event_dict.update(self.unable_to_decrypt)
-            else:
-                raise
+        key = self._decrypted_event_key(event)
 
+        if key and not isinstance(session.result, OlmGroupSessionError):
+            try:
+                self.decrypted_events[key] = session.result
+            except ValueError:
+                # The payload doesn't fit into the cache.
+                pass
+
+        self._replace_decrypted_event(event_dict, decrypted_event)
+
+        return True
+
+    def pan_decrypt_event(self, event_dict, room_id=None, ignore_failures=True):
+        # type: (Dict[Any, Any], Optional[str], bool) -> (bool)
+        event = self._parse_megolm_event(event_dict, room_id)
+
+        if not event:
             return False
 
-    def decrypt_messages_body(self, body, ignore_failures=True):
+        session = self.olm.inbound_group_store.get(
+            event.room_id, event.sender_key, event.session_id
+        )
+
+        if session:
+            result = self.decrypted_events.get(self._decrypted_event_key(event))
+            session = DecryptedSession(session, event.ciphertext, result)
+
+            return self._decrypt_with_session(
+                event_dict, event, session, ignore_failures
+            )
+
+        # Let nio handle the missing session, this marks the session as wedged
+        # if needed.
+        try:
+            decrypted_event = self.decrypt_event(event)
+        except EncryptionError as error:
+            self._decryption_failed(event_dict, error, ignore_failures)
+            return False
+
+        self._replace_decrypted_event(event_dict, decrypted_event)
+
+        return True
+
+    async def decrypt_room_events(self, events, room_id=None, ignore_failures=True):
+        # type: (List[Dict[Any, Any]], Optional[str], bool) -> None
+        """Decrypt a batch of megolm encrypted events in place.
+
+        Events that were already decrypted once are taken from the decrypted
+        event cache. If the client has a decryption pool the remaining
+        ciphertexts are decrypted in a worker thread using snapshots of the
+        sessions they need. The results are handed to nio, which does the
+        same checks as for events that it decrypts itself.
+
+        Args:
+            events (List[Dict[Any, Any]]): The encrypted events, all of them
+                should belong to the same room.
+            room_id (str, optional): The room the events belong to, if it
+                isn't part of the events.
+            ignore_failures (bool): Should events that fail to decrypt be
+                replaced with an error message, otherwise the first error is
+                raised.
+        """
+        if not self.decryption_pool:
+            for event_dict in events:
+                self.pan_decrypt_event(event_dict, room_id, ignore_failures)
+            return
+
+        pending = []
+        pickles = {}
+
+        for event_dict in events:
+            event = self._parse_megolm_event(event_dict, room_id)
+
+            if not event:
+                continue
+
+            session = self.olm.inbound_group_store.get(
+                event.room_id, event.sender_key, event.session_id
+            )
+
+            if not session:
+                self.pan_decrypt_event(event_dict, room_id, ignore_failures)
+                continue
+
+            result = self.decrypted_events.get(self._decrypted_event_key(event))
+
+            if result:
+                self._decrypt_with_session(
+                    event_dict,
+                    event,
+                    DecryptedSession(session, event.ciphertext, result),
+                    ignore_failures,
+                )
+                continue
+
+            if session.id not in pickles:
+                pickles[session.id] = session.pickle()
+
+            pending.append((event_dict, event, session))
+
+        if not pending:
+            return
+
+        loop = asyncio.get_event_loop()
+        results = await loop.run_in_executor(
+            self.decryption_pool,
+            decrypt_megolm_ciphertexts,
+            [(pickles[session.id], event.ciphertext) for _, event, session in pending],
+        )
+
+        for (event_dict, event, session), result in zip(pending, results):
+            self._decrypt_with_session(
+                event_dict,
+                event,
+                DecryptedSession(session, event.ciphertext, result),
+                ignore_failures,
+            )
+
+    async def decrypt_messages_body(self, body, ignore_failures=True):
         # type: (Dict[Any, Any], bool) -> Dict[Any, Any]
         """Go through a messages response and decrypt megolm encrypted events.
 
@@ -870,6 +1375,8 @@ class PanClient(AsyncClient):
 
         logger.info("Decrypting room messages")
 
+        events = []
+
         for event in body["chunk"]:
             if "type" not in event:
                 continue
@@ -878,36 +1385,148 @@ class PanClient(AsyncClient):
                 logger.debug("Event is not encrypted: " "\n{}".format(pformat(event)))
                 continue
 
-            self.pan_decrypt_event(event, ignore_failures=ignore_failures)
+            events.append(event)
+
+        await self.decrypt_room_events(events, ignore_failures=ignore_failures)
 
         return body
 
+    def _first_to_device_handling(self, event_dict):
+        # type: (Dict[Any, Any]) -> bool
+        """Check if a to-device event is seen for the first time and remember
+        it."""
+        key = to_device_event_key(event_dict)
+
+        if key in self.handled_to_device_events:
+            return False
+
+        self.handled_to_device_events[key] = True
+
+        return True
+
+    def _handle_decrypt_to_device(self, to_device_event):
+        # The event might have been handled already on the sync stream of a
+        # client, decrypting an Olm message twice fails.
+        if not self._first_to_device_handling(to_device_event.source):
+            return None
+
+        return super()._handle_decrypt_to_device(to_device_event)
+
+    async def _handle_to_device(self, response):
+        with self.batch_session_saves():
+            await super()._handle_to_device(response)
+
     def handle_to_device_from_sync_body(self, body):
         to_device_events = body.get("to_device")
 
         if not to_device_events or "events" not in to_device_events:
             return
 
-        for event in to_device_events["events"]:
-            event = ToDeviceEvent.parse_encrypted_event(event)
+        with self.batch_session_saves():
+            for event_dict in to_device_events["events"]:
+                event = ToDeviceEvent.parse_encrypted_event(event_dict)
 
-            if not isinstance(event, ToDeviceEvent):
-                continue
+                if not isinstance(event, ToDeviceEvent):
+                    continue
 
-            self.olm.handle_to_device_event(event)
+                if not self._first_to_device_handling(event_dict):
+                    continue
 
-    def decrypt_sync_body(self, body, ignore_failures=True):
-        # type: (Dict[Any, Any], bool) -> Dict[Any, Any]
+                decrypted_event = self.olm.handle_to_device_event(event)
+
+                if isinstance(decrypted_event, (RoomKeyEvent, ForwardedRoomKeyEvent)):
+                    self.room_key_received(
+                        decrypted_event.room_id, decrypted_event.session_id
+                    )
+
+    def batch_session_saves(self):
+        """Save the Megolm sessions that are received while the context is
+        active in a single transaction."""
+        if isinstance(self.store, BatchedSqliteStore):
+            return self.store.batch_session_saves()
+
+        return nullcontext()
+
+    async def import_keys(self, infile, passphrase):
+        """Import Megolm decryption keys.
+
+        The imported sessions are saved to the database in a single
+        transaction if the store supports it.
+
+        Args:
+            infile (str): The file containing the keys.
+            passphrase (str): The decryption passphrase.
+        """
+        loop = asyncio.get_event_loop()
+
+        sessions = await loop.run_in_executor(
+            None, Olm.import_keys_static, infile, passphrase
+        )
+        sessions = [s for s in sessions if self.olm.inbound_group_store.add(s)]
+
+        if isinstance(self.store, BatchedSqliteStore):
+            await loop.run_in_executor(
+                None, self.store.save_inbound_group_sessions, sessions
+            )
+        else:
+            for session in sessions:
+                self.store.save_inbound_group_session(session)
+
+        for session in sessions:
+            self.room_key_received(session.room_id, session.id)
+
+    def undecrypted_sessions(self, body, sync=True):
+        # type: (Dict[Any, Any], bool) -> Set[Tuple[str, str]]
+        """Get the room keys of the events of a sync or messages body that are
+        still encrypted.
+
+        Args:
+            body (Dict[Any, Any]): The dictionary of the response.
+            sync (bool): Is the body a sync response or a messages response.
+
+        Returns a set of room id and session id pairs.
+        """
+        if sync:
+            rooms = (
+                (room_id, room_dict.get("timeline", {}).get("events", []))
+                for room_id, room_dict in body.get("rooms", {}).get("join", {}).items()
+            )
+        else:
+            rooms = [(None, body.get("chunk", []))]
+
+        sessions = set()
+
+        for room_id, events in rooms:
+            for event in events:
+                if event.get("type") != "m.room.encrypted":
+                    continue
+
+                session_id = event.get("content", {}).get("session_id")
+
+                if session_id:
+                    sessions.add((event.get("room_id", room_id), session_id))
+
+        return sessions
+
+    async def decrypt_sync_body(self, body, ignore_failures=True, to_device=True):
+        # type: (Dict[Any, Any], bool, bool) -> Dict[Any, Any]
         """Go through a json sync response and decrypt megolm encrypted events.
 
+        The rooms of the sync response are decrypted concurrently.
+
         Args:
             body (Dict[Any, Any]): The dictionary of a Sync response.
+            to_device (bool): Should the to-device events of the response be
+                handled.
 
         Returns the json response with decrypted events.
         """
         logger.info("Decrypting sync")
 
-        self.handle_to_device_from_sync_body(body)
+        if to_device:
+            self.handle_to_device_from_sync_body(body)
+
+        room_tasks = []
 
         for room_id, room_dict in body.get("rooms", {}).get("join", {}).items():
             try:
@@ -924,6 +1543,8 @@ class PanClient(AsyncClient):
                 # pan sync stream did. Let's assume that the room is encrypted.
                 pass
 
+            events = []
+
             for event in room_dict.get("timeline", {}).get("events", []):
                 if "type" not in event:
                     continue
@@ -931,7 +1552,20 @@ class PanClient(AsyncClient):
                 if event["type"] != "m.room.encrypted":
                     continue
 
-                self.pan_decrypt_event(event, room_id, ignore_failures)
+                events.append(event)
+
+            if events:
+                room_tasks.append(
+                    self.decrypt_room_events(events, room_id, ignore_failures)
+                )
+
+        # Let all the rooms finish before an error is raised so no decryption
+        # is left running in the background.
+        results = await asyncio.gather(*room_tasks, return_exceptions=True)
+
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
 
         return body
 
@@ -0,0 +1,106 @@
+# Copyright 2019 The Matrix.org Foundation CIC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""The JSON codec used for the bodies pantalaimon parses and creates.
+
+The fastest available backend is picked when the module is imported, orjson
+and ujson are used if they are installed, otherwise the codec falls back to
+the json module of the standard library.
+
+The output of dumps_bytes() is only stable for equal objects if the keys are
+sorted, pass sort_keys=True if the output is hashed or compared.
+"""
+
+import json
+from json import JSONDecodeError
+from typing import Any, Union
+
+from aiohttp import web
+
+try:
+    import orjson
+
+    JSON_BACKEND = "orjson"
+
+    def loads(data):
+        # type: (Union[str, bytes]) -> Any
+        return orjson.loads(data)
+
+    def dumps_bytes(obj, *, sort_keys=False):
+        # type: (Any, bool) -> bytes
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS if sort_keys else 0)
+
+    def dumps(obj):
+        # type: (Any) -> str
+        return orjson.dumps(obj).decode("utf-8")
+
+except ImportError:
+    try:
+        import ujson
+
+        JSON_BACKEND = "ujson"
+
+        def loads(data):
+            # type: (Union[str, bytes]) -> Any
+            try:
+                return ujson.loads(data)
+            except ValueError as e:
+                # Callers expect the exception of the json module.
+                raise JSONDecodeError(str(e), "", 0) from e
+
+        def dumps(obj):
+            # type: (Any) -> str
+            return ujson.dumps(obj, ensure_ascii=False, escape_forward_slashes=False)
+
+        def dumps_bytes(obj, *, sort_keys=False):
+            # type: (Any, bool) -> bytes
+            return ujson.dumps(
+                obj,
+                ensure_ascii=False,
+                escape_forward_slashes=False,
+                sort_keys=sort_keys,
+            ).encode("utf-8")
+
+    except ImportError:
+        JSON_BACKEND = "json"
+
+        loads = json.loads
+
+        def dumps(obj):
+            # type: (Any) -> str
+            return json.dumps(obj)
+
+        def dumps_bytes(obj, *, sort_keys=False):
+            # type: (Any, bool) -> bytes
+            return json.dumps(obj, sort_keys=sort_keys).encode("utf-8")
+
+
+def json_response(data, *, status=200, reason=None, headers=None):
+    """Create a JSON response using the selected codec.
+
+    This is a replacement for aiohttp.web.json_response().
+
+    Args:
+        data (Any): The object that should be serialized as the body.
+        status (int): The HTTP status of the response.
+        reason (str, optional): The HTTP reason phrase of the response.
+        headers (Dict[str, str], optional): Additional response headers.
+    """
+    return web.Response(
+        body=dumps_bytes(data),
+        status=status,
+        reason=reason,
+        headers=headers,
+        content_type="application/json",
+    )
@@ -40,6 +40,20 @@ class PanConfigParser(configparser.ConfigParser):
                 "HistoryFetchDelay": "3000",
                 "DebugEncryption": "False",
                 "DropOldKeys": "False",
+                "ConnectionLimit": "100",
+                "ConnectionLimitPerHost": "0",
+                "KeepAliveTimeout": "15",
+                "DnsCacheTTL": "10",
+                "DecryptionWorkers": "2",
+                "DecryptedEventCacheSize": "16",
+                "MediaDecryptionWorkers": "2",
+                "MediaDecryptionBackend": "thread",
+                "MediaCacheSize": "0",
+                "MediaCacheEncryption": "True",
+                "StorageProfile": "default",
+                "GroupSessionCacheSize": "0",
+                "SyncMultiplexing": "False",
+                "DecryptionTimeout": "10",
             },
             converters={
                 "address": parse_address,
@@ -124,6 +138,37 @@ class ServerConfig:
             requests in seconds.
         drop_old_keys (bool): Should Pantalaimon only keep the most recent
             decryption key around.
+        connection_limit (int): The maximum number of connections that are
+            kept open to the homeserver, 0 means no limit.
+        connection_limit_per_host (int): The maximum number of connections
+            to a single host and port, 0 means no limit.
+        keepalive_timeout (int): The number of seconds an idle connection is
+            kept around so it can be reused.
+        dns_cache_ttl (int): The number of seconds resolved homeserver
+            addresses are cached for.
+        decryption_workers (int): The number of threads that are used to
+            decrypt the events of sync and messages responses, 0 decrypts them
+            on the event loop.
+        decrypted_event_cache_size (int): The size in megabytes of the
+            in-memory cache of decrypted event payloads, 0 disables the cache.
+        media_decryption_workers (int): The number of workers that are used to
+            decrypt media downloads, 0 decrypts them on the event loop.
+        media_decryption_backend (str): The kind of workers that decrypt media
+            downloads, either "thread" or "process".
+        media_cache_size (int): The size in megabytes of the on-disk cache for
+            downloaded media, 0 disables the cache.
+        media_cache_encryption (bool): Should the media cache store the
+            encrypted attachments instead of the decrypted media.
+        storage_profile (str): The set of SQLite settings the databases are
+            opened with, either "default" or "wal".
+        group_session_cache_size (int): The number of Megolm sessions that
+            are kept in memory, sessions are loaded from the store on demand.
+            0 loads all the sessions at startup.
+        sync_multiplexing (bool): Should clients that continue the sync
+            stream of the background sync client be served from it instead of
+            syncing with the homeserver themselves.
+        decryption_timeout (float): The number of seconds a sync or messages
+            response is held back while waiting for missing room keys.
     """
 
     name = attr.ib(type=str)
@@ -141,6 +186,20 @@ class ServerConfig:
     indexing_batch_size = attr.ib(type=int, default=100)
     history_fetch_delay = attr.ib(type=int, default=3)
     drop_old_keys = attr.ib(type=bool, default=False)
+    connection_limit = attr.ib(type=int, default=100)
+    connection_limit_per_host = attr.ib(type=int, default=0)
+    keepalive_timeout = attr.ib(type=int, default=15)
+    dns_cache_ttl = attr.ib(type=int, default=10)
+    decryption_workers = attr.ib(type=int, default=2)
+    decrypted_event_cache_size = attr.ib(type=int, default=16)
+    media_decryption_workers = attr.ib(type=int, default=2)
+    media_decryption_backend = attr.ib(type=str, default="thread")
+    media_cache_size = attr.ib(type=int, default=0)
+    media_cache_encryption = attr.ib(type=bool, default=True)
+    storage_profile = attr.ib(type=str, default="default")
+    group_session_cache_size = attr.ib(type=int, default=0)
+    sync_multiplexing = attr.ib(type=bool, default=False)
+    decryption_timeout = attr.ib(type=float, default=10)
 
 
 @attr.s
@@ -235,6 +294,88 @@ class PanConfig:
                 listen_set.add(listen_tuple)
                 drop_old_keys = section.getboolean("DropOldKeys")
 
+                connection_limit = section.getint("ConnectionLimit")
+                connection_limit_per_host = section.getint("ConnectionLimitPerHost")
+                keepalive_timeout = section.getint("KeepAliveTimeout")
+                dns_cache_ttl = section.getint("DnsCacheTTL")
+
+                if (
+                    min(
+                        connection_limit,
+                        connection_limit_per_host,
+                        keepalive_timeout,
+                        dns_cache_ttl,
+                    )
+                    < 0
+                ):
+                    raise PanConfigError(
+                        "The connection pool settings need to be "
+                        "non-negative integers"
+                    )
+
+                decryption_workers = section.getint("DecryptionWorkers")
+
+                if decryption_workers < 0:
+                    raise PanConfigError(
+                        "The number of decryption workers needs to be "
+                        "a non-negative integer"
+                    )
+
+                decrypted_event_cache_size = section.getint("DecryptedEventCacheSize")
+
+                if decrypted_event_cache_size < 0:
+                    raise PanConfigError(
+                        "The decrypted event cache size needs to be "
+                        "a non-negative integer"
+                    )
+
+                media_decryption_workers = section.getint("MediaDecryptionWorkers")
+
+                if media_decryption_workers < 0:
+                    raise PanConfigError(
+                        "The number of media decryption workers needs to be "
+                        "a non-negative integer"
+                    )
+
+                media_decryption_backend = section.get("MediaDecryptionBackend").lower()
+
+                if media_decryption_backend not in ("thread", "process"):
+                    raise PanConfigError(
+                        "The media decryption backend needs to be "
+                        'either "thread" or "process"'
+                    )
+
+                media_cache_size = section.getint("MediaCacheSize")
+
+                if media_cache_size < 0:
+                    raise PanConfigError(
+                        "The media cache size needs to be a non-negative integer"
+                    )
+
+                media_cache_encryption = section.getboolean("MediaCacheEncryption")
+                storage_profile = section.get("StorageProfile").lower()
+
+                if storage_profile not in ("default", "wal"):
+                    raise PanConfigError(
+                        'The storage profile needs to be either "default" or "wal"'
+                    )
+
+                group_session_cache_size = section.getint("GroupSessionCacheSize")
+
+                if group_session_cache_size < 0:
+                    raise PanConfigError(
+                        "The group session cache size needs to be a "
+                        "non-negative integer"
+                    )
+
+                sync_multiplexing = section.getboolean("SyncMultiplexing")
+                decryption_timeout = section.getfloat("DecryptionTimeout")
+
+                if decryption_timeout < 0:
+                    raise PanConfigError(
+                        "The decryption timeout needs to be a non-negative number"
+                    )
+
                 server_conf = ServerConfig(
                     section_name,
                     homeserver,
@@ -249,6 +390,20 @@ class PanConfig:
                     indexing_batch_size,
                     history_fetch_delay / 1000,
                     drop_old_keys,
+                    connection_limit,
+                    connection_limit_per_host,
+                    keepalive_timeout,
+                    dns_cache_ttl,
+                    decryption_workers,
+                    decrypted_event_cache_size,
+                    media_decryption_workers,
+                    media_decryption_backend,
+                    media_cache_size,
+                    media_cache_encryption,
+                    storage_profile,
+                    group_session_cache_size,
+                    sync_multiplexing,
+                    decryption_timeout,
                 )
 
                 self.servers[section_name] = server_conf
@@ -13,21 +13,22 @@
 # limitations under the License.
 
 import asyncio
-import json
 import os
+import re
 import urllib.parse
 import concurrent.futures
+from functools import partial
 from io import BufferedReader, BytesIO
-from json import JSONDecodeError
-from typing import Any, Dict
+from typing import Any, Dict, Optional
 from urllib.parse import urlparse
 from uuid import uuid4
 
 import aiohttp
 import attr
 import keyring
-from aiohttp import ClientSession, web
+from aiohttp import ClientSession, TCPConnector, web
 from aiohttp.client_exceptions import ClientConnectionError, ContentTypeError
+from cachetools import LRUCache, TTLCache
 from jsonschema import ValidationError
 from multidict import CIMultiDict
 from nio import (
@@ -49,9 +50,18 @@ from pantalaimon.client import (
     UnknownRoomError,
     validate_json,
 )
+from pantalaimon.codec import JSONDecodeError, dumps, json_response, loads
 from pantalaimon.index import INDEXING_ENABLED, InvalidQueryError
 from pantalaimon.log import logger
-from pantalaimon.store import ClientInfo, PanStore, MediaInfo
+from pantalaimon.media import AttachmentDecryptor, AttachmentEncryptor, MediaCache
+from pantalaimon.store import (
+    MAX_LOADED_MEDIA,
+    MAX_LOADED_UPLOAD,
+    ClientInfo,
+    MediaInfo,
+    PanStore,
+    ReadThroughCache,
+)
 from pantalaimon.thread_messages import (
     AcceptSasMessage,
     CancelSasMessage,
@@ -74,6 +84,37 @@ from pantalaimon.thread_messages import (
     CancelKeyShare,
 )
 
+# The size of the chunks we read from the homeserver while relaying a
+# response.
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# The number of clients that are restored at the same time at startup.
+RESTORE_WORKERS = 4
+
+# The number of client access tokens we remember and the number of seconds
+# after which we ask the homeserver again who a token belongs to.
+MAX_CACHED_TOKENS = 1000
+TOKEN_CACHE_TTL = 5 * 60
+# The number of seconds we remember that a token was rejected.
+INVALID_TOKEN_CACHE_TTL = 30
+
+# The Content-Range header of a partial response of the homeserver.
+CONTENT_RANGE_RE = re.compile(r"^bytes (\d+)-(\d+)/(\d+|\*)$")
+
+# Media smaller than this is decrypted on the event loop, handing it to the
+# media decryption pool would cost more than the decryption itself.
+INLINE_MEDIA_DECRYPTION_SIZE = 256 * 1024
+
+# The event types pantalaimon needs to handle in sync and messages responses,
+# the encrypted room and to-device events and the to-device events of key
+# sharing and device verification. Responses that contain none of them are
+# passed to the client without being parsed.
+HANDLED_EVENT_TYPES = (
+    b'"m.room.encrypted"',
+    b'"m.room_key_request"',
+    b'"m.key.verification.',
+)
+
 CORS_HEADERS = {
     "Access-Control-Allow-Headers": (
         "Origin, X-Requested-With, Content-Type, Accept, Authorization"
@@ -82,6 +123,25 @@ CORS_HEADERS = {
     "Access-Control-Allow-Origin": "*",
 }
 
+# Headers of a homeserver response that aren't relayed to the client. The
+# hop-by-hop headers only apply to the connection to the homeserver, the body
+# is decompressed by the client session so the Content-Encoding and
+# Content-Length of the homeserver don't apply to the relayed body either.
+UNRELAYED_HEADERS = frozenset(
+    (
+        "connection",
+        "keep-alive",
+        "proxy-authenticate",
+        "proxy-authorization",
+        "te",
+        "trailer",
+        "transfer-encoding",
+        "upgrade",
+        "content-encoding",
+        "content-length",
+    )
+)
+
 
 class NotDecryptedAvailableError(Exception):
     """Exception that signals that no decrypted upload is available"""
@@ -101,17 +161,40 @@ class ProxyDaemon:
     ssl = attr.ib(default=None)
     client_store_class = attr.ib(default=None)
 
-    decryption_timeout = 10
     unverified_send_timeout = 60
 
+    decryption_timeout = attr.ib(type=float, init=False, default=10)
     store = attr.ib(type=PanStore, init=False)
     homeserver_url = attr.ib(init=False, default=attr.Factory(dict))
     hostname = attr.ib(init=False, default=attr.Factory(dict))
     pan_clients = attr.ib(init=False, default=attr.Factory(dict))
-    client_info = attr.ib(init=False, default=attr.Factory(dict), type=dict)
+    client_info = attr.ib(
+        init=False,
+        default=attr.Factory(lambda: TTLCache(MAX_CACHED_TOKENS, TOKEN_CACHE_TTL)),
+        type=TTLCache,
+    )
+    invalid_tokens = attr.ib(
+        init=False,
+        default=attr.Factory(
+            lambda: TTLCache(MAX_CACHED_TOKENS, INVALID_TOKEN_CACHE_TTL)
+        ),
+        type=TTLCache,
+    )
+    known_tokens = attr.ib(
+        init=False,
+        default=attr.Factory(lambda: LRUCache(MAX_CACHED_TOKENS)),
+        type=LRUCache,
+    )
+    token_lookups = attr.ib(init=False, default=attr.Factory(dict), type=dict)
     default_session = attr.ib(init=False, default=None)
+    decryption_pool = attr.ib(init=False, default=None)
+    media_decryption_pool = attr.ib(init=False, default=None)
+    media_cache = attr.ib(init=False, default=None)
     media_info = attr.ib(init=False, default=None)
     upload_info = attr.ib(init=False, default=None)
+    decrypted_uploads = attr.ib(init=False, default=None)
+    client_ready = attr.ib(init=False, default=attr.Factory(dict))
+    restore_task = attr.ib(init=False, default=None)
     database_name = "pan.db"
 
     def __attrs_post_init__(self):
@@ -119,30 +202,118 @@ class ProxyDaemon:
 
         self.homeserver_url = self.homeserver.geturl()
         self.hostname = self.homeserver.hostname
-        self.store = PanStore(self.data_dir)
+        self.decryption_timeout = self.conf.decryption_timeout
+        self.store = PanStore(self.data_dir, storage_profile=self.conf.storage_profile)
         accounts = self.store.load_users(self.name)
-        self.media_info = self.store.load_media_cache(self.name)
-        self.upload_info = self.store.load_upload(self.name)
-
-        for user_id, device_id in accounts:
-            token = None
+        self.media_info = ReadThroughCache(
+            MAX_LOADED_MEDIA,
+            lambda key: self.store.aio.load_media(self.name, *key),
+        )
+        self.upload_info = ReadThroughCache(
+            MAX_LOADED_UPLOAD,
+            lambda content_uri: self.store.aio.load_upload(self.name, content_uri),
+        )
+        self.decrypted_uploads = ReadThroughCache(
+            MAX_LOADED_UPLOAD,
+            lambda content_uri: self.store.aio.load_decrypted_uploads(
+                self.name, content_uri
+            ),
+        )
+        self.media_info.update(self.store.load_media_cache(self.name))
+        self.upload_info.update(self.store.load_upload(self.name))
+        self.decrypted_uploads.update(self.store.load_decrypted_uploads(self.name))
+
+        if self.conf.decryption_workers:
+            self.decryption_pool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.conf.decryption_workers,
+                thread_name_prefix=f"{self.name}-decryption",
+            )
 
-            if self.conf.keyring:
-                try:
-                    token = keyring.get_password(
-                        "pantalaimon", f"{user_id}-{device_id}-token"
-                    )
-                except RuntimeError as e:
-                    logger.error(e)
+        if self.conf.media_decryption_workers:
+            if self.conf.media_decryption_backend == "process":
+                self.media_decryption_pool = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.conf.media_decryption_workers
+                )
             else:
-                token = self.store.load_access_token(user_id, device_id)
+                self.media_decryption_pool = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.conf.media_decryption_workers,
+                    thread_name_prefix=f"{self.name}-media-decryption",
+                )
+
+        if self.conf.media_cache_size:
+            self.media_cache = MediaCache(
+                os.path.join(self.data_dir, "media", self.name),
+                self.conf.media_cache_size * 1024 * 1024,
+                self.conf.media_cache_encryption,
+            )
+
+        # The clients are restored in the background so the proxy can start
+        # accepting requests right away.
+        for user_id, _ in accounts:
+            self.client_ready[user_id] = asyncio.Event()
+
+        self.restore_task = loop.create_task(self.restore_clients(accounts))
+
+    def _load_access_token(self, user_id, device_id):
+        # type: (str, str) -> Optional[str]
+        if self.conf.keyring:
+            try:
+                return keyring.get_password(
+                    "pantalaimon", f"{user_id}-{device_id}-token"
+                )
+            except RuntimeError as e:
+                logger.error(e)
+                return None
+
+        return self.store.load_access_token(user_id, device_id)
+
+    async def restore_clients(self, accounts):
+        """Restore the background sync clients of the accounts that were
+        logged in before.
+
+        The clients are restored concurrently, the access token lookups and
+        the loading of the client stores run on a worker pool. Requests for
+        an account wait until its client is restored.
+
+        Args:
+            accounts (List[Tuple[str, str]]): The user and device ids of the
+                accounts.
+        """
+        pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=RESTORE_WORKERS, thread_name_prefix=f"{self.name}-restore"
+        )
+
+        try:
+            results = await asyncio.gather(
+                *(
+                    self._restore_client(pool, user_id, device_id)
+                    for user_id, device_id in accounts
+                ),
+                return_exceptions=True,
+            )
+        finally:
+            pool.shutdown(wait=False)
+
+        for (user_id, device_id), result in zip(accounts, results):
+            if isinstance(result, Exception):
+                logger.error(
+                    f"Error restoring client for {user_id} {device_id}: {result}"
+                )
+
+    async def _restore_client(self, pool, user_id, device_id):
+        loop = asyncio.get_event_loop()
+
+        try:
+            token = await loop.run_in_executor(
+                pool, self._load_access_token, user_id, device_id
+            )
 
             if not token:
                 logger.warn(
                     f"Not restoring client for {user_id} {device_id}, "
                     f"missing access token."
                 )
-                continue
+                return
 
             logger.info(f"Restoring client for {user_id} {device_id}")
 
@@ -159,68 +330,170 @@ class ProxyDaemon:
                 proxy=self.proxy,
                 store_class=self.client_store_class,
                 media_info=self.media_info,
+                decryption_pool=self.decryption_pool,
             )
             pan_client.user_id = user_id
             pan_client.access_token = token
-            pan_client.load_store()
+
+            await loop.run_in_executor(pool, pan_client.load_store)
+
             self.pan_clients[user_id] = pan_client
+        finally:
+            self.client_ready.pop(user_id).set()
 
-            loop.create_task(
-                self.send_ui_message(
-                    UpdateUsersMessage(self.name, user_id, pan_client.device_id)
-                )
+        logger.info(f"Restored client for {user_id} {device_id}")
+
+        await self.send_ui_message(
+            UpdateUsersMessage(self.name, user_id, pan_client.device_id)
+        )
+        await pan_client.send_update_devices(pan_client.device_store)
+
+        pan_client.start_loop()
+
+    async def _wait_for_client(self, user_id):
+        # type: (str) -> Optional[PanClient]
+        """Get the client of a user, waiting for it if it's being restored."""
+        ready = self.client_ready.get(user_id)
+
+        if ready:
+            await ready.wait()
+
+        return self.pan_clients.get(user_id)
+
+    async def _wait_for_any_client(self):
+        # type: () -> Optional[PanClient]
+        """Get one of the clients, waiting for the restore of the clients if
+        none of them is ready yet."""
+        if (
+            not self.pan_clients
+            and self.restore_task is not None
+            and not self.restore_task.done()
+        ):
+            # Waiting doesn't cancel the restore if our request gets cancelled.
+            await asyncio.wait({self.restore_task})
+
+        return next(iter(self.pan_clients.values()), None)
+
+    def get_session(self):
+        # type: () -> aiohttp.ClientSession
+        """Get the client session used to talk to the homeserver.
+
+        The session is created on first use, all the connections to the
+        homeserver are pooled in its connector so they can be reused between
+        requests.
+        """
+        if not self.default_session:
+            connector = TCPConnector(
+                limit=self.conf.connection_limit,
+                limit_per_host=self.conf.connection_limit_per_host,
+                keepalive_timeout=self.conf.keepalive_timeout,
+                use_dns_cache=self.conf.dns_cache_ttl > 0,
+                ttl_dns_cache=self.conf.dns_cache_ttl,
             )
+            self.default_session = ClientSession(connector=connector)
 
-            loop.create_task(pan_client.send_update_devices(pan_client.device_store))
+        return self.default_session
 
-            pan_client.start_loop()
+    async def _resolve_token(self, access_token):
+        # type: (str) -> Optional[ClientInfo]
+        """Ask the homeserver who the given access token belongs to.
 
-    async def _find_client(self, access_token):
-        client_info = self.client_info.get(access_token, None)
+        Tokens that the homeserver rejects, or that belong to a user without
+        a pan client, are remembered for a short while so we don't ask again
+        for every request that uses them.
 
-        if not client_info:
-            async with aiohttp.ClientSession() as session:
-                try:
-                    method, path = Api.whoami(access_token)
-                    resp = await session.request(
-                        method,
-                        self.homeserver_url + path,
-                        proxy=self.proxy,
-                        ssl=self.ssl,
-                    )
-                except ClientConnectionError:
+        If the homeserver can't be asked, a token that was confirmed before
+        keeps its previous info, it's only dropped once the homeserver
+        rejects it.
+        """
+        session = self.get_session()
+
+        try:
+            method, path = Api.whoami(access_token)
+            async with session.request(
+                method,
+                self.homeserver_url + path,
+                proxy=self.proxy,
+                ssl=self.ssl,
+            ) as resp:
+                if resp.status in (401, 403):
+                    self._forget_token(access_token)
                     return None
 
                 if resp.status != 200:
-                    return None
+                    return self._keep_known_token(access_token)
 
                 try:
-                    body = await resp.json()
+                    body = await resp.json(loads=loads)
                 except (JSONDecodeError, ContentTypeError):
-                    return None
+                    return self._keep_known_token(access_token)
+        except ClientConnectionError:
+            return self._keep_known_token(access_token)
 
-                try:
-                    user_id = body["user_id"]
-                except KeyError:
-                    return None
+        try:
+            user_id = body["user_id"]
+        except KeyError:
+            return self._keep_known_token(access_token)
 
-                if user_id not in self.pan_clients:
-                    logger.warn(
-                        f"User {user_id} doesn't have a matching pan " f"client."
-                    )
-                    return None
+        if not await self._wait_for_client(user_id):
+            logger.warn(f"User {user_id} doesn't have a matching pan " f"client.")
+            self._forget_token(access_token)
+            return None
 
-                logger.info(
-                    f"Homeserver confirmed valid access token "
-                    f"for user {user_id}, caching info."
+        logger.info(
+            f"Homeserver confirmed valid access token "
+            f"for user {user_id}, caching info."
+        )
+
+        client_info = ClientInfo(user_id, access_token)
+        self.client_info[access_token] = client_info
+        self.known_tokens[access_token] = client_info
+
+        return client_info
+
+    def _forget_token(self, access_token):
+        # type: (str) -> None
+        self.known_tokens.pop(access_token, None)
+        self.invalid_tokens[access_token] = True
+
+    def _keep_known_token(self, access_token):
+        # type: (str) -> Optional[ClientInfo]
+        client_info = self.known_tokens.get(access_token, None)
+
+        if client_info:
+            logger.warn(
+                f"Couldn't revalidate the access token of {client_info.user_id}, "
+                f"keeping the previous info."
+            )
+            self.client_info[access_token] = client_info
+
+        return client_info
+
+    async def _find_client(self, access_token):
+        client_info = self.client_info.get(access_token, None)
+
+        if not client_info:
+            if access_token in self.invalid_tokens:
+                return None
+
+            # Requests that arrive while a lookup for the same token is in
+            # flight wait for its result instead of asking the homeserver
+            # again.
+            lookup = self.token_lookups.get(access_token, None)
+
+            if not lookup:
+                lookup = asyncio.ensure_future(self._resolve_token(access_token))
+                self.token_lookups[access_token] = lookup
+                lookup.add_done_callback(
+                    lambda _: self.token_lookups.pop(access_token, None)
                 )
 
-                client_info = ClientInfo(user_id, access_token)
-                self.client_info[access_token] = client_info
+            client_info = await asyncio.shield(lookup)
 
-        client = self.pan_clients.get(client_info.user_id, None)
+            if not client_info:
+                return None
 
-        return client
+        return await self._wait_for_client(client_info.user_id)
 
     async def _verify_device(self, message_id, client, device):
         ret = client.verify_device(device)
@@ -465,6 +738,7 @@ class ProxyDaemon:
         session=None,  # type: aiohttp.ClientSession
         token=None,  # type: str
         use_raw_path=True,  # type: bool
+        buffered=False,  # type: bool
     ):
         # type: (...) -> aiohttp.ClientResponse
         """Forward the given request to our configured homeserver.
@@ -483,13 +757,12 @@ class ProxyDaemon:
             request or should we use the path and re-encode it. Some may need
             their filters to be sanitized, this requires the parsed version of
             the path, otherwise we leave the path as is.
+            buffered (bool, optional): Should the request body be read in full
+            before it is forwarded. This is needed if the handler already
+            consumed the body, otherwise the body is streamed to the
+            homeserver as it arrives.
         """
-        if not session:
-            if not self.default_session:
-                self.default_session = ClientSession()
-            session = self.default_session
-
-        assert session
+        session = session or self.get_session()
 
         path = request.raw_path if use_raw_path else urllib.parse.quote(request.path)
         method = request.method
@@ -506,10 +779,14 @@ class ProxyDaemon:
                 params["access_token"] = token
 
         if data:
-            data = data
             headers.pop("Content-Length", None)
-        else:
+        elif buffered:
             data = await request.read()
+        elif request.body_exists:
+            # Pipe the body through as we receive it, the client session
+            # decides on the transfer encoding of the upstream request.
+            data = request.content
+            headers.pop("Transfer-Encoding", None)
 
         return await session.request(
             method,
@@ -522,7 +799,7 @@ class ProxyDaemon:
         )
 
     async def forward_to_web(
-        self, request, params=None, data=None, session=None, token=None
+        self, request, params=None, data=None, session=None, token=None, buffered=False
     ):
         """Forward the given request and convert the response to a Response.
 
@@ -540,20 +817,67 @@ class ProxyDaemon:
                 should be used to forward the request.
             token (str, optional): The access token that should be used for the
                 request.
+            buffered (bool, optional): Should the request body be read in full
+                before it is forwarded, see forward_request().
         """
         try:
             response = await self.forward_request(
-                request, params=params, data=data, session=session, token=token
-            )
-            return web.Response(
-                status=response.status,
-                content_type=response.content_type,
-                headers=CORS_HEADERS,
-                body=await response.read(),
+                request,
+                params=params,
+                data=data,
+                session=session,
+                token=token,
+                buffered=buffered,
             )
         except ClientConnectionError as e:
             return web.Response(status=500, text=str(e))
 
+        return await self.stream_to_web(request, response)
+
+    async def stream_to_web(self, request, response):
+        """Relay the body of a homeserver response to the client.
+
+        The body is passed through chunk by chunk as it arrives instead of
+        being buffered, this is used for all the responses that we don't need
+        to modify. The headers of the homeserver response are relayed as well,
+        except for the ones in UNRELAYED_HEADERS.
+
+        Args:
+            request (aiohttp.BaseRequest): The client request we are
+                responding to.
+            response (aiohttp.ClientResponse): The response of the homeserver
+                that should be relayed.
+        """
+        headers = CIMultiDict(
+            (name, value)
+            for name, value in response.headers.items()
+            if name.lower() not in UNRELAYED_HEADERS
+        )
+        headers.update(CORS_HEADERS)
+
+        web_response = web.StreamResponse(status=response.status, headers=headers)
+        web_response.content_type = response.content_type
+
+        # The body gets decompressed by the client session, the length is only
+        # valid if no content encoding was applied.
+        if (
+            response.content_length is not None
+            and "Content-Encoding" not in response.headers
+        ):
+            web_response.content_length = response.content_length
+
+        try:
+            await web_response.prepare(request)
+
+            async for chunk in response.content.iter_chunked(STREAM_CHUNK_SIZE):
+                await web_response.write(chunk)
+
+            await web_response.write_eof()
+        finally:
+            response.release()
+
+        return web_response
+
     async def router(self, request):
         """Catchall request router."""
         return await self.forward_to_web(request)
@@ -576,9 +900,11 @@ class ProxyDaemon:
     ):
         client = ClientInfo(user_id, access_token)
         self.client_info[access_token] = client
-        self.store.save_server_user(self.name, user_id)
+        self.known_tokens[access_token] = client
+        self.invalid_tokens.pop(access_token, None)
+        await self.store.aio.save_server_user(self.name, user_id)
 
-        if user_id in self.pan_clients:
+        if await self._wait_for_client(user_id):
             logger.info(
                 f"Background sync client already exists for {user_id},"
                 f" not starting new one"
@@ -597,6 +923,7 @@ class ProxyDaemon:
             proxy=self.proxy,
             store_class=self.client_store_class,
             media_info=self.media_info,
+            decryption_pool=self.decryption_pool,
         )
 
         if password == "":
@@ -642,7 +969,7 @@ class ProxyDaemon:
 
     async def login(self, request):
         try:
-            body = await request.json()
+            body = await request.json(loads=loads)
         except (JSONDecodeError, ContentTypeError):
             # After a long debugging session the culprit ended up being aiohttp
             # and a similar bug to
@@ -652,7 +979,7 @@ class ProxyDaemon:
             # Return 500 here for now since quaternion doesn't work otherwise.
             # After aiohttp 4.0 gets replace this with a 400 M_NOT_JSON
             # response.
-            return web.json_response(
+            return json_response(
                 {
                     "errcode": "M_NOT_JSON",
                     "error": "Request did not contain valid JSON.",
@@ -666,19 +993,19 @@ class ProxyDaemon:
         logger.info(f"New user logging in: {user}")
 
         try:
-            response = await self.forward_request(request)
+            response = await self.forward_request(request, buffered=True)
         except ClientConnectionError as e:
             return web.Response(status=500, text=str(e))
 
         try:
-            json_response = await response.json()
+            login_response = await response.json(loads=loads)
         except (JSONDecodeError, ContentTypeError):
-            json_response = None
+            login_response = None
 
-        if response.status == 200 and json_response:
-            user_id = json_response.get("user_id", None)
-            access_token = json_response.get("access_token", None)
-            device_id = json_response.get("device_id", None)
+        if response.status == 200 and login_response:
+            user_id = login_response.get("user_id", None)
+            access_token = login_response.get("access_token", None)
+            device_id = login_response.get("device_id", None)
 
             if user_id and access_token:
                 logger.info(
@@ -698,7 +1025,7 @@ class ProxyDaemon:
 
     @property
     def _missing_token(self):
-        return web.json_response(
+        return json_response(
             {"errcode": "M_MISSING_TOKEN", "error": "Missing access token."},
             headers=CORS_HEADERS,
             status=401,
@@ -706,7 +1033,7 @@ class ProxyDaemon:
 
     @property
     def _unknown_token(self):
-        return web.json_response(
+        return json_response(
             {"errcode": "M_UNKNOWN_TOKEN", "error": "Unrecognised access token."},
             headers=CORS_HEADERS,
             status=401,
@@ -714,35 +1041,112 @@ class ProxyDaemon:
 
     @property
     def _not_json(self):
-        return web.json_response(
+        return json_response(
             {"errcode": "M_NOT_JSON", "error": "Request did not contain valid JSON."},
             headers=CORS_HEADERS,
             status=400,
         )
 
-    async def decrypt_body(self, client, body, sync=True):
-        """Try to decrypt the a sync or messages body."""
-        decryption_method = (
-            client.decrypt_sync_body if sync else client.decrypt_messages_body
-        )
+    @staticmethod
+    def needs_decryption(body):
+        # type: (bytes) -> bool
+        """Check if a raw sync or messages body contains events that
+        pantalaimon needs to handle.
+
+        This is a plain substring search, so a false positive only costs a
+        full parse of the body.
+        """
+        return any(event_type in body for event_type in HANDLED_EVENT_TYPES)
+
+    async def decrypt_body(self, client, body, sync=True, to_device=True):
+        """Try to decrypt the a sync or messages body.
+
+        Events that fail to decrypt are tried again as soon as one of the room
+        keys they need arrives, until the decryption timeout runs out. After
+        that the remaining events are replaced with an error message.
+        """
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + self.decryption_timeout
+
+        while True:
+            decryption_method = (
+                partial(client.decrypt_sync_body, to_device=to_device)
+                if sync
+                else client.decrypt_messages_body
+            )
 
-        async def decrypt_loop(client, body):
-            while True:
+            # The keys are watched before the attempt, a key that arrives
+            # while the events are being decrypted wakes us up right away.
+            watched = client.undecrypted_sessions(body, sync)
+
+            with client.watch_room_keys(watched) as waiters:
                 try:
                     logger.info("Trying to decrypt sync")
-                    return decryption_method(body, ignore_failures=False)
+                    return await decryption_method(body, ignore_failures=False)
                 except EncryptionError:
-                    logger.info("Error decrypting sync, waiting for next pan " "sync")
-                    await client.synced.wait(),
-                    logger.info("Pan synced, retrying decryption.")
+                    pass
+
+                # Events are decrypted in place, so the next attempt only
+                # touches the ones that are still encrypted. The to-device
+                # events were handled by the first attempt.
+                to_device = False
+                sessions = client.undecrypted_sessions(body, sync)
+                pending = [waiters[key] for key in sessions if key in waiters]
+                timeout = deadline - loop.time()
+
+                if timeout <= 0 or not pending:
+                    break
+
+                logger.info(
+                    f"Error decrypting sync, waiting for {len(pending)} room keys"
+                )
+
+                done, _ = await asyncio.wait(
+                    pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+                )
 
+                if not done:
+                    break
+
+            logger.info("Received a room key, retrying decryption.")
+
+        logger.info("Giving up waiting for room keys, decrypting with failures")
+        return await decryption_method(body, ignore_failures=True)
+
+    @staticmethod
+    def _can_share_sync(query):
+        """Check if a sync request can be served from the sync stream of the
+        background sync client."""
+        return (
+            "since" in query
+            and "filter" not in query
+            and query.get("full_state", "false") == "false"
+        )
+
+    async def _shared_sync(self, client, query):
+        """Serve a sync request from the sync stream of a pan client.
+
+        Returns None if the request can't be served from the stream.
+        """
         try:
-            return await asyncio.wait_for(
-                decrypt_loop(client, body), timeout=self.decryption_timeout
+            timeout = int(query.get("timeout", 0)) / 1000
+        except ValueError:
+            timeout = 0
+
+        body = await client.sync_stream.get(query["since"], timeout)
+
+        if body is None:
+            return None
+
+        if not self.needs_decryption(body):
+            return web.Response(
+                content_type="application/json", headers=CORS_HEADERS, body=body
             )
-        except asyncio.TimeoutError:
-            logger.info("Decryption attempt timed out, decrypting with " "failures")
-            return decryption_method(body, ignore_failures=True)
+
+        # The to-device events were already handled by the sync loop.
+        body = await self.decrypt_body(client, loads(body), to_device=False)
+
+        return json_response(body, headers=CORS_HEADERS)
 
     async def sync(self, request):
         access_token = self.get_access_token(request)
@@ -754,17 +1158,23 @@ class ProxyDaemon:
         if not client:
             return self._unknown_token
 
+        if client.sync_stream and self._can_share_sync(request.query):
+            response = await self._shared_sync(client, request.query)
+
+            if response is not None:
+                return response
+
         sync_filter = request.query.get("filter", None)
         query = CIMultiDict(request.query)
 
         if sync_filter:
             try:
-                sync_filter = json.loads(sync_filter)
+                sync_filter = loads(sync_filter)
             except (JSONDecodeError, TypeError):
                 pass
 
             if isinstance(sync_filter, dict):
-                sync_filter = json.dumps(self.sanitize_filter(sync_filter))
+                sync_filter = dumps(self.sanitize_filter(sync_filter))
 
             query["filter"] = sync_filter
 
@@ -775,14 +1185,12 @@ class ProxyDaemon:
         except ClientConnectionError as e:
             return web.Response(status=500, text=str(e))
 
-        if response.status == 200:
+        if response.status == 200 and self.needs_decryption(await response.read()):
             try:
-                json_response = await response.json()
-                json_response = await self.decrypt_body(client, json_response)
+                body = await response.json(loads=loads)
+                body = await self.decrypt_body(client, body)
 
-                return web.json_response(
-                    json_response, headers=CORS_HEADERS, status=response.status
-                )
+                return json_response(body, headers=CORS_HEADERS, status=response.status)
             except (JSONDecodeError, ContentTypeError):
                 pass
 
@@ -808,12 +1216,12 @@ class ProxyDaemon:
 
         if request_filter:
             try:
-                request_filter = json.loads(request_filter)
+                request_filter = loads(request_filter)
             except (JSONDecodeError, TypeError):
                 pass
 
             if isinstance(request_filter, dict):
-                request_filter = json.dumps(self.sanitize_filter(request_filter))
+                request_filter = dumps(self.sanitize_filter(request_filter))
 
             query["filter"] = request_filter
 
@@ -824,16 +1232,12 @@ class ProxyDaemon:
         except ClientConnectionError as e:
             return web.Response(status=500, text=str(e))
 
-        if response.status == 200:
+        if response.status == 200 and self.needs_decryption(await response.read()):
             try:
-                json_response = await response.json()
-                json_response = await self.decrypt_body(
-                    client, json_response, sync=False
-                )
+                body = await response.json(loads=loads)
+                body = await self.decrypt_body(client, body, sync=False)
 
-                return web.json_response(
-                    json_response, headers=CORS_HEADERS, status=response.status
-                )
+                return json_response(body, headers=CORS_HEADERS, status=response.status)
             except (JSONDecodeError, ContentTypeError):
                 pass
 
@@ -844,30 +1248,38 @@ class ProxyDaemon:
             body=await response.read(),
         )
 
-    def _get_upload_and_media_info(self, content_uri: str):
-        try:
-            upload_info = self.upload_info[content_uri]
-        except KeyError:
-            upload_info = self.store.load_upload(self.name, content_uri)
-            if not upload_info:
-                return None, None
+    async def _get_upload_and_media_info(self, content_uri: str):
+        # Without a URI the store would load its most recent uploads.
+        if not content_uri:
+            return None, None
 
-        self.upload_info[content_uri] = upload_info
+        upload_info = await self.upload_info.get(content_uri)
+        if not upload_info:
+            return None, None
 
         mxc = urlparse(content_uri)
         mxc_server = mxc.netloc.strip("/")
         mxc_path = mxc.path.strip("/")
 
-        media_info = self.store.load_media(self.name, mxc_server, mxc_path)
+        media_info = await self.media_info.get((mxc_server, mxc_path))
         if not media_info:
             return None, None
 
-        self.media_info[(mxc_server, mxc_path)] = media_info
-
         return upload_info, media_info
 
     async def _decrypt_uri(self, content_uri, client):
-        upload_info, media_info = self._get_upload_and_media_info(content_uri)
+        """Get the URI of a plaintext copy of an encrypted upload.
+
+        The plaintext is uploaded once, the URI of the copy is remembered and
+        reused every time the same encrypted upload is sent to an unencrypted
+        room again.
+        """
+        decrypted_content_uri = await self.decrypted_uploads.get(content_uri)
+
+        if decrypted_content_uri:
+            return decrypted_content_uri
+
+        upload_info, media_info = await self._get_upload_and_media_info(content_uri)
         if not upload_info or not media_info:
             raise NotDecryptedAvailableError
 
@@ -892,6 +1304,11 @@ class ProxyDaemon:
         if not isinstance(decrypted_upload, UploadResponse):
             raise NotDecryptedAvailableError
 
+        self.decrypted_uploads[content_uri] = decrypted_upload.content_uri
+        await self.store.aio.save_decrypted_upload(
+            self.name, content_uri, decrypted_upload.content_uri
+        )
+
         return decrypted_upload.content_uri
 
     async def send_message(self, request):
@@ -914,7 +1331,7 @@ class ProxyDaemon:
             # didn't manage to sync the state or we're not joined, in either
             # case send an error response.
             if client.has_been_synced:
-                return web.json_response(
+                return json_response(
                     {
                         "errcode": "M_FORBIDDEN",
                         "error": "You do not have permission to send the event.",
@@ -927,7 +1344,7 @@ class ProxyDaemon:
                     "The internal Pantalaimon client did not manage "
                     "to sync with the server."
                 )
-                return web.json_response(
+                return json_response(
                     {
                         "errcode": "M_UNKNOWN",
                         "error": "The pantalaimon client did not manage to sync with "
@@ -946,7 +1363,7 @@ class ProxyDaemon:
         msgtype = request.match_info["event_type"]
 
         try:
-            content = await request.json()
+            content = await request.json(loads=loads)
         except (JSONDecodeError, ContentTypeError):
             return self._not_json
 
@@ -968,14 +1385,18 @@ class ProxyDaemon:
                             content["info"]["thumbnail_url"], client
                         )
                     return await self.forward_to_web(
-                        request, data=json.dumps(content), token=client.access_token
+                        request, data=dumps(content), token=client.access_token
                     )
                 except ClientConnectionError as e:
                     return web.Response(status=500, text=str(e))
                 except (KeyError, NotDecryptedAvailableError):
-                    return await self.forward_to_web(request, token=client.access_token)
+                    return await self.forward_to_web(
+                        request, token=client.access_token, buffered=True
+                    )
 
-            return await self.forward_to_web(request, token=client.access_token)
+            return await self.forward_to_web(
+                request, token=client.access_token, buffered=True
+            )
 
         txnid = request.match_info.get("txnid", uuid4())
 
@@ -986,7 +1407,7 @@ class ProxyDaemon:
                     content_msgtype in ["m.image", "m.video", "m.audio", "m.file"]
                     or msgtype == "m.room.avatar"
                 ):
-                    upload_info, media_info = self._get_upload_and_media_info(
+                    upload_info, media_info = await self._get_upload_and_media_info(
                         content["url"]
                     )
                     if not upload_info or not media_info:
@@ -1006,7 +1427,7 @@ class ProxyDaemon:
                         (
                             thumb_upload_info,
                             thumb_media_info,
-                        ) = self._get_upload_and_media_info(
+                        ) = await self._get_upload_and_media_info(
                             content["info"]["thumbnail_url"]
                         )
                         if thumb_upload_info and thumb_media_info:
@@ -1122,16 +1543,16 @@ class ProxyDaemon:
             return self._missing_token
 
         try:
-            content = await request.json()
+            content = await request.json(loads=loads)
         except (JSONDecodeError, ContentTypeError):
             return self._not_json
 
         sanitized_content = self.sanitize_filter(content)
 
-        return await self.forward_to_web(request, data=json.dumps(sanitized_content))
+        return await self.forward_to_web(request, data=dumps(sanitized_content))
 
     async def search_opts(self, request):
-        return web.json_response({}, headers=CORS_HEADERS)
+        return json_response({}, headers=CORS_HEADERS)
 
     async def search(self, request):
         access_token = self.get_access_token(request)
@@ -1148,14 +1569,14 @@ class ProxyDaemon:
             return self._unknown_token
 
         try:
-            content = await request.json()
+            content = await request.json(loads=loads)
         except (JSONDecodeError, ContentTypeError):
             return self._not_json
 
         try:
             validate_json(content, SEARCH_TERMS_SCHEMA)
         except ValidationError:
-            return web.json_response(
+            return json_response(
                 {"errcode": "M_BAD_JSON", "error": "Invalid search query"},
                 headers=CORS_HEADERS,
                 status=400,
@@ -1177,100 +1598,293 @@ class ProxyDaemon:
                         break
 
                 except KeyError:
-                    return await self.forward_to_web(request)
+                    return await self.forward_to_web(request, buffered=True)
             else:
-                return await self.forward_to_web(request)
+                return await self.forward_to_web(request, buffered=True)
 
         try:
             result = await client.search(content)
         except (InvalidOrderByError, InvalidLimit, InvalidQueryError) as e:
-            return web.json_response(
+            return json_response(
                 {"errcode": "M_INVALID_PARAM", "error": str(e)},
                 headers=CORS_HEADERS,
                 status=400,
             )
         except UnknownRoomError:
-            return await self.forward_to_web(request)
+            return await self.forward_to_web(request, buffered=True)
 
-        return web.json_response(result, headers=CORS_HEADERS, status=200)
+        return json_response(result, headers=CORS_HEADERS, status=200)
 
     async def upload(self, request):
+        """Encrypt a file that the client uploads and pass it on to the
+        homeserver.
+
+        The request body is encrypted chunk by chunk while it's being streamed
+        to the homeserver, the file is never held in memory as a whole.
+        """
         file_name = request.query.get("filename", "")
         content_type = request.headers.get("Content-Type", "application/octet-stream")
-        client = next(iter(self.pan_clients.values()))
+        client = await self._wait_for_any_client()
+
+        if not client:
+            return web.Response(status=500, text="No client is logged in.")
+
+        method, path, _ = Api.upload(client.access_token, file_name)
+        encryptor = AttachmentEncryptor()
+        headers = {"Content-Type": "application/octet-stream"}
+
+        # AES-CTR doesn't change the length of the data, homeservers may
+        # refuse uploads without a length.
+        if request.content_length is not None:
+            headers["Content-Length"] = str(request.content_length)
+
+        async def encrypted_body():
+            async for chunk in request.content.iter_chunked(STREAM_CHUNK_SIZE):
+                yield encryptor.encrypt(chunk)
 
-        body = await request.read()
         try:
-            response, maybe_keys = await client.upload(
-                data_provider=BufferedReader(BytesIO(body)),
-                content_type=content_type,
-                filename=file_name,
-                encrypt=True,
-                filesize=len(body),
-            )
+            async with self.get_session().request(
+                method,
+                self.homeserver_url + path,
+                data=encrypted_body(),
+                headers=headers,
+                proxy=self.proxy,
+                ssl=self.ssl,
+            ) as response:
+                if response.status != 200:
+                    return await self.stream_to_web(request, response)
+
+                body = await response.read()
+
+                try:
+                    content_uri = loads(body)["content_uri"]
+                except (JSONDecodeError, KeyError, TypeError):
+                    return web.Response(
+                        status=response.status,
+                        content_type=response.content_type,
+                        headers=CORS_HEADERS,
+                        body=body,
+                    )
+
+                await self.store.aio.save_upload(
+                    self.name, content_uri, file_name, content_type
+                )
+
+                mxc = urlparse(content_uri)
+                mxc_server = mxc.netloc.strip("/")
+                mxc_path = mxc.path.strip("/")
+                keys = encryptor.decryption_info()
+
+                logger.info(
+                    f"Adding media info for {mxc_server}/{mxc_path} to the store"
+                )
+                media_info = MediaInfo(
+                    mxc_server,
+                    mxc_path,
+                    keys["key"],
+                    keys["iv"],
+                    keys["hashes"],
+                )
+                self.store.save_media(self.name, media_info)
 
-            if not isinstance(response, UploadResponse):
                 return web.Response(
-                    status=response.transport_response.status,
-                    content_type=response.transport_response.content_type,
+                    status=response.status,
+                    content_type=response.content_type,
                     headers=CORS_HEADERS,
-                    body=await response.transport_response.read(),
+                    body=body,
                 )
 
-            self.store.save_upload(
-                self.name, response.content_uri, file_name, content_type
-            )
+        except ClientConnectionError as e:
+            return web.Response(status=500, text=str(e))
+
+    async def _find_media_info(self, server_name, media_id):
+        # type: (str, str) -> Optional[MediaInfo]
+        media_info = await self.media_info.get((server_name, media_id))
+
+        if not media_info:
+            logger.info(f"No media info found for {server_name}/{media_id}")
+
+        return media_info
 
-            mxc = urlparse(response.content_uri)
-            mxc_server = mxc.netloc.strip("/")
-            mxc_path = mxc.path.strip("/")
-
-            logger.info(f"Adding media info for {mxc_server}/{mxc_path} to the store")
-            media_info = MediaInfo(
-                mxc_server,
-                mxc_path,
-                maybe_keys["key"],
-                maybe_keys["iv"],
-                maybe_keys["hashes"],
+    @staticmethod
+    def _media_info_complete(media_info):
+        # type: (MediaInfo) -> bool
+        return "k" in media_info.key and "sha256" in media_info.hashes
+
+    async def _decrypt_media(self, attachment, media_info):
+        # type: (bytes, MediaInfo) -> bytes
+        key = media_info.key["k"]
+        hash = media_info.hashes["sha256"]
+
+        if (
+            self.media_decryption_pool
+            and len(attachment) > INLINE_MEDIA_DECRYPTION_SIZE
+        ):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                self.media_decryption_pool,
+                decrypt_attachment,
+                attachment,
+                key,
+                hash,
+                media_info.iv,
             )
-            self.store.save_media(self.name, media_info)
 
-            return web.Response(
-                status=response.transport_response.status,
-                content_type=response.transport_response.content_type,
-                headers=CORS_HEADERS,
-                body=await response.transport_response.read(),
+        return decrypt_attachment(attachment, key, hash, media_info.iv)
+
+    async def _cache_media(self, media_info, attachment, decrypted_file, content_type):
+        loop = asyncio.get_running_loop()
+
+        try:
+            await loop.run_in_executor(
+                None,
+                self.media_cache.store,
+                media_info,
+                attachment,
+                decrypted_file,
+                content_type,
             )
+        except OSError as e:
+            logger.warn(f"Error storing media in the media cache: {e}")
 
-        except ClientConnectionError as e:
-            return web.Response(status=500, text=str(e))
-        except SendRetryError as e:
-            return web.Response(status=503, text=str(e))
+    async def _load_cached_media(self, request, server_name, media_id):
+        # type: (web.BaseRequest, str, str) -> Optional[web.StreamResponse]
+        if not self.media_cache:
+            return None
+
+        media_info = await self._find_media_info(server_name, media_id)
+
+        if not media_info or not self._media_info_complete(media_info):
+            return None
+
+        loop = asyncio.get_running_loop()
+        cached = await loop.run_in_executor(None, self.media_cache.lookup, media_info)
+
+        if not cached:
+            return None
+
+        logger.info(f"Serving media {server_name}/{media_id} from the media cache")
+
+        if not cached.encrypted:
+            headers = CIMultiDict(CORS_HEADERS)
+            headers["Content-Type"] = cached.content_type
+
+            # The file response handles range requests itself.
+            return web.FileResponse(cached.path, headers=headers)
+
+        return await self._stream_cached_media(request, cached, media_info)
+
+    async def _stream_cached_media(self, request, cached, media_info):
+        """Stream a file of an encrypted media cache to the client.
+
+        Only the part of the file that the client asked for in its Range
+        header is read and decrypted. If the whole file is read the last chunk
+        of the plaintext is held back until the hash of the attachment is
+        verified, a file that doesn't match its hash is dropped from the cache.
+
+        Args:
+            request (aiohttp.BaseRequest): The download request of the
+                client.
+            cached (CachedMedia): The cached encrypted attachment.
+            media_info (MediaInfo): The media info of the attachment.
+        """
+        headers = CIMultiDict(CORS_HEADERS)
+        headers["Accept-Ranges"] = "bytes"
 
-    async def _load_decrypted_file(self, server_name, media_id, file_name):
         try:
-            media_info = self.media_info[(server_name, media_id)]
-        except KeyError:
-            media_info = self.store.load_media(self.name, server_name, media_id)
+            requested_range = request.http_range
+        except ValueError:
+            requested_range = slice(None, None)
+
+        start, stop, _ = requested_range.indices(cached.size)
+        status = 200
 
-            if not media_info:
-                logger.info(f"No media info found for {server_name}/{media_id}")
-                return None, None
+        if requested_range.start is not None or requested_range.stop is not None:
+            if start >= stop:
+                headers["Content-Range"] = f"bytes */{cached.size}"
+                return web.Response(status=416, headers=headers)
 
-            self.media_info[(server_name, media_id)] = media_info
+            status = 206
+            headers["Content-Range"] = f"bytes {start}-{stop - 1}/{cached.size}"
+
+        decryptor = AttachmentDecryptor(
+            media_info.key["k"], media_info.hashes["sha256"], media_info.iv, start
+        )
+
+        web_response = web.StreamResponse(status=status, headers=headers)
+        web_response.content_type = cached.content_type
+        web_response.content_length = stop - start
+
+        loop = asyncio.get_running_loop()
+        verify = start == 0 and stop == cached.size
 
         try:
-            key = media_info.key["k"]
-            hash = media_info.hashes["sha256"]
-        except KeyError as e:
+            with open(cached.path, "rb") as f:
+                f.seek(start)
+                await web_response.prepare(request)
+
+                remaining = stop - start
+                held_back = b""
+
+                while remaining:
+                    chunk = await loop.run_in_executor(
+                        None, f.read, min(STREAM_CHUNK_SIZE, remaining)
+                    )
+
+                    if not chunk:
+                        break
+
+                    remaining -= len(chunk)
+
+                    if held_back:
+                        await web_response.write(held_back)
+
+                    held_back = decryptor.decrypt(chunk)
+
+                    if not verify:
+                        await web_response.write(held_back)
+                        held_back = b""
+
+            if verify:
+                decryptor.verify()
+                await web_response.write(held_back)
+
+            await web_response.write_eof()
+        except EncryptionError as e:
             logger.warn(
-                f"Media info for {server_name}/{media_id} doesn't contain a key or hash."
+                f"Dropping media {media_info.mxc_server}/{media_info.mxc_path} "
+                f"from the media cache: {e}"
             )
-            raise e
-        if not self.pan_clients:
+            await loop.run_in_executor(
+                None, self.media_cache.remove, media_info, cached
+            )
+
+            if request.transport:
+                request.transport.close()
+        except OSError as e:
+            logger.warn(f"Error streaming media from the media cache: {e}")
+
+            if request.transport:
+                request.transport.close()
+
+        return web_response
+
+    async def _load_decrypted_file(self, server_name, media_id, file_name):
+        media_info = await self._find_media_info(server_name, media_id)
+
+        if not media_info:
             return None, None
 
-        client = next(iter(self.pan_clients.values()))
+        if not self._media_info_complete(media_info):
+            logger.warn(
+                f"Media info for {server_name}/{media_id} doesn't contain a key or hash."
+            )
+            raise KeyError(f"Incomplete media info for {server_name}/{media_id}")
+
+        client = await self._wait_for_any_client()
+
+        if not client:
+            return None, None
 
         try:
             response = await client.download(server_name=server_name, media_id=media_id, filename=file_name)
@@ -1282,10 +1896,11 @@ class ProxyDaemon:
 
         logger.info(f"Decrypting media {server_name}/{media_id}")
 
-        loop = asyncio.get_running_loop()
-        with concurrent.futures.ProcessPoolExecutor() as pool:
-            decrypted_file = await loop.run_in_executor(
-                pool, decrypt_attachment, response.body, key, hash, media_info.iv
+        decrypted_file = await self._decrypt_media(response.body, media_info)
+
+        if self.media_cache:
+            await self._cache_media(
+                media_info, response.body, decrypted_file, response.content_type
             )
 
         return response, decrypted_file
@@ -1301,7 +1916,7 @@ class ProxyDaemon:
             return self._unknown_token
 
         try:
-            content = await request.json()
+            content = await request.json(loads=loads)
         except (JSONDecodeError, ContentTypeError):
             return self._not_json
 
@@ -1310,12 +1925,180 @@ class ProxyDaemon:
                 content["avatar_url"], client
             )
             return await self.forward_to_web(
-                request, data=json.dumps(content), token=client.access_token
+                request, data=dumps(content), token=client.access_token
             )
         except ClientConnectionError as e:
             return web.Response(status=500, text=str(e))
         except (KeyError, NotDecryptedAvailableError):
-            return await self.forward_to_web(request, token=client.access_token)
+            return await self.forward_to_web(
+                request, token=client.access_token, buffered=True
+            )
+
+    async def _stream_decrypted_file(self, request, media_info, file_name):
+        """Download an encrypted attachment and stream it to the client while
+        it's being decrypted.
+
+        The last chunk of the plaintext is held back until the hash of the
+        attachment is verified. If the hash doesn't match the connection is
+        closed before the response is complete, so the client never gets a
+        complete response with the wrong content.
+
+        Args:
+            request (aiohttp.BaseRequest): The download request of the
+                client.
+            media_info (MediaInfo): The media info of the attachment.
+            file_name (str, optional): The file name the client asked for.
+        """
+        method, path = Api.download(
+            media_info.mxc_server, media_info.mxc_path, file_name
+        )
+        session = self.get_session()
+        headers = {}
+
+        # A single byte range is passed on to the homeserver, the same range
+        # of the attachment decrypts to the requested range of the media.
+        if "Range" in request.headers:
+            try:
+                request.http_range
+            except ValueError:
+                logger.debug("Ignoring an unsupported Range header")
+            else:
+                headers["Range"] = request.headers["Range"]
+
+        async with session.request(
+            method,
+            self.homeserver_url + path,
+            headers=headers,
+            proxy=self.proxy,
+            ssl=self.ssl,
+        ) as response:
+            if response.status == 206:
+                return await self._stream_decrypted_range(request, response, media_info)
+
+            if response.status != 200:
+                return await self.stream_to_web(request, response)
+
+            decryptor = AttachmentDecryptor(
+                media_info.key["k"], media_info.hashes["sha256"], media_info.iv
+            )
+            cache_writer = None
+
+            if self.media_cache:
+                cache_writer = self.media_cache.writer(
+                    media_info, response.content_type
+                )
+
+            web_response = web.StreamResponse(status=200, headers=CORS_HEADERS)
+            web_response.content_type = response.content_type
+
+            if "Accept-Ranges" in response.headers:
+                web_response.headers["Accept-Ranges"] = response.headers[
+                    "Accept-Ranges"
+                ]
+
+            # AES-CTR doesn't change the length of the data.
+            if (
+                response.content_length is not None
+                and "Content-Encoding" not in response.headers
+            ):
+                web_response.content_length = response.content_length
+
+            logger.info(
+                f"Decrypting media {media_info.mxc_server}/{media_info.mxc_path}"
+            )
+
+            try:
+                await web_response.prepare(request)
+
+                held_back = b""
+
+                async for chunk in response.content.iter_chunked(STREAM_CHUNK_SIZE):
+                    plaintext = decryptor.decrypt(chunk)
+
+                    if cache_writer:
+                        cache_writer.write(chunk, plaintext)
+
+                    if held_back:
+                        await web_response.write(held_back)
+
+                    held_back = plaintext
+
+                decryptor.verify()
+
+                await web_response.write(held_back)
+                await web_response.write_eof()
+            except (EncryptionError, ClientConnectionError, OSError) as e:
+                logger.warn(
+                    f"Error streaming media {media_info.mxc_server}/"
+                    f"{media_info.mxc_path}: {e}"
+                )
+
+                if cache_writer:
+                    cache_writer.discard()
+
+                if request.transport:
+                    request.transport.close()
+
+                return web_response
+
+            if cache_writer:
+                cache_writer.commit()
+
+            return web_response
+
+    async def _stream_decrypted_range(self, request, response, media_info):
+        """Stream a part of an encrypted attachment to the client while it's
+        being decrypted.
+
+        Only the counter blocks of the part that the homeserver returned are
+        decrypted. The hash of the attachment covers the whole file, a part
+        of it can't be verified.
+
+        Args:
+            request (aiohttp.BaseRequest): The download request of the
+                client.
+            response (aiohttp.ClientResponse): The partial response of the
+                homeserver.
+            media_info (MediaInfo): The media info of the attachment.
+        """
+        match = CONTENT_RANGE_RE.match(response.headers.get("Content-Range", ""))
+
+        if not match:
+            return web.Response(
+                status=502, text="Invalid Content-Range from the homeserver"
+            )
+
+        start, end = int(match.group(1)), int(match.group(2))
+
+        decryptor = AttachmentDecryptor(
+            media_info.key["k"], media_info.hashes["sha256"], media_info.iv, start
+        )
+
+        headers = CIMultiDict(CORS_HEADERS)
+        headers["Accept-Ranges"] = "bytes"
+        headers["Content-Range"] = response.headers["Content-Range"]
+
+        web_response = web.StreamResponse(status=206, headers=headers)
+        web_response.content_type = response.content_type
+        web_response.content_length = end - start + 1
+
+        try:
+            await web_response.prepare(request)
+
+            async for chunk in response.content.iter_chunked(STREAM_CHUNK_SIZE):
+                await web_response.write(decryptor.decrypt(chunk))
+
+            await web_response.write_eof()
+        except (ClientConnectionError, OSError) as e:
+            logger.warn(
+                f"Error streaming media {media_info.mxc_server}/"
+                f"{media_info.mxc_path}: {e}"
+            )
+
+            if request.transport:
+                request.transport.close()
+
+        return web_response
 
     async def download(self, request):
         server_name = request.match_info["server_name"]
@@ -1323,31 +2106,25 @@ class ProxyDaemon:
         file_name = request.match_info.get("file_name")
 
         try:
-            response, decrypted_file = await self._load_decrypted_file(
-                server_name, media_id, file_name
+            cached_response = await self._load_cached_media(
+                request, server_name, media_id
             )
 
-            if response is None and decrypted_file is None:
+            if cached_response is not None:
+                return cached_response
+
+            media_info = await self._find_media_info(server_name, media_id)
+
+            if (
+                not media_info
+                or not self._media_info_complete(media_info)
+                or not await self._wait_for_any_client()
+            ):
                 return await self.forward_to_web(request)
+
+            return await self._stream_decrypted_file(request, media_info, file_name)
         except ClientConnectionError as e:
             return web.Response(status=500, text=str(e))
-        except KeyError:
-            return await self.forward_to_web(request)
-
-        if not isinstance(response, DownloadResponse):
-            return web.Response(
-                status=response.transport_response.status,
-                content_type=response.transport_response.content_type,
-                headers=CORS_HEADERS,
-                body=await response.transport_response.read(),
-            )
-
-        return web.Response(
-            status=response.transport_response.status,
-            content_type=response.transport_response.content_type,
-            headers=CORS_HEADERS,
-            body=decrypted_file,
-        )
 
     async def well_known(self, _):
         """Intercept well-known requests
@@ -1362,6 +2139,10 @@ class ProxyDaemon:
 
         This method is called when we shut the whole app down.
         """
+        if self.restore_task:
+            self.restore_task.cancel()
+            await asyncio.wait({self.restore_task})
+
         for client in self.pan_clients.values():
             await client.loop_stop()
             await client.close()
@@ -1369,3 +2150,23 @@ class ProxyDaemon:
         if self.default_session:
             await self.default_session.close()
             self.default_session = None
+
+        if self.decryption_pool:
+            self.decryption_pool.shutdown(wait=False)
+            self.decryption_pool = None
+
+        if self.media_decryption_pool:
+            self.media_decryption_pool.shutdown(wait=False)
+            self.media_decryption_pool = None
+
+        for cache_name, cache in (
+            ("media info", self.media_info),
+            ("upload info", self.upload_info),
+            ("decrypted upload", self.decrypted_uploads),
+        ):
+            logger.debug(
+                f"The {cache_name} cache of {self.name} had {cache.hits} hits "
+                f"and {cache.misses} misses"
+            )
+
+        self.store.close()
@@ -20,7 +20,6 @@ class InvalidQueryError(Exception):
 if False:
     import asyncio
     import datetime
-    import json
     import os
     from functools import partial
     from typing import Any, Dict, List, Optional, Tuple
@@ -43,16 +42,21 @@ if False:
         TextField,
     )
 
-    from pantalaimon.store import use_database
+    from pantalaimon.codec import dumps, loads
+    from pantalaimon.store import (
+        STORAGE_PROFILES,
+        LockedSqliteDatabase,
+        use_database,
+    )
 
     INDEXING_ENABLED = True
 
     class DictField(TextField):
         def python_value(self, value):  # pragma: no cover
-            return json.loads(value)
+            return loads(value)
 
         def db_value(self, value):  # pragma: no cover
-            return json.dumps(value)
+            return dumps(value)
 
     class StoreUser(Model):
         user_id = TextField()
@@ -90,6 +94,7 @@ if False:
         user = attr.ib(type=str)
         store_path = attr.ib(type=str)
         database_name = attr.ib(type=str)
+        storage_profile = attr.ib(type=str, default="default")
         database = attr.ib(type=SqliteDatabase, init=False)
         database_path = attr.ib(type=str, init=False)
 
@@ -107,8 +112,8 @@ if False:
                 self.database.create_tables(self.models)
 
         def _create_database(self):
-            return SqliteDatabase(
-                self.database_path, pragmas={"foreign_keys": 1, "secure_delete": 1}
+            return LockedSqliteDatabase(
+                self.database_path, pragmas=STORAGE_PROFILES[self.storage_profile]
             )
 
         @use_database
@@ -408,6 +413,7 @@ if False:
         index_path = attr.ib(type=str)
         store_path = attr.ib(type=str, default=None)
         store_name = attr.ib(default="events.db")
+        storage_profile = attr.ib(type=str, default="default")
 
         index = attr.ib(type=Index, init=False)
         store = attr.ib(type=MessageStore, init=False)
@@ -420,7 +426,9 @@ if False:
             num_searchers = os.cpu_count()
             self.index = Index(self.index_path, num_searchers)
             self.read_semaphore = asyncio.Semaphore(num_searchers or 1)
-            self.store = MessageStore(self.user, self.store_path, self.store_name)
+            self.store = MessageStore(
+                self.user, self.store_path, self.store_name, self.storage_profile
+            )
 
         def add_event(self, event, room_id, display_name, avatar_url):
             item = StoreItem(event, room_id, display_name, avatar_url)
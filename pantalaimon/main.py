@@ -26,10 +26,15 @@ from aiohttp import web
 from appdirs import user_config_dir, user_data_dir
 from logbook import StderrHandler
 
+from pantalaimon.codec import JSON_BACKEND
 from pantalaimon.config import PanConfig, PanConfigError, parse_log_level
 from pantalaimon.daemon import ProxyDaemon
 from pantalaimon.log import logger
-from pantalaimon.store import KeyDroppingSqliteStore
+from pantalaimon.store import (
+    BatchedSqliteStore,
+    KeyDroppingSqliteStore,
+    lazy_session_store_class,
+)
 from pantalaimon.thread_messages import DaemonResponse
 from pantalaimon.ui import UI_ENABLED
 
@@ -48,7 +53,14 @@ def create_dirs(data_dir, conf_dir):
 
 async def init(data_dir, server_conf, send_queue, recv_queue):
     """Initialize the proxy and the http server."""
-    store_class = KeyDroppingSqliteStore if server_conf.drop_old_keys else None
+    store_class = (
+        KeyDroppingSqliteStore if server_conf.drop_old_keys else BatchedSqliteStore
+    )
+
+    if server_conf.group_session_cache_size:
+        store_class = lazy_session_store_class(
+            store_class, server_conf.group_session_cache_size
+        )
 
     proxy = ProxyDaemon(
         server_conf.name,
@@ -204,6 +216,8 @@ async def daemon(context, log_level, debug_encryption, config, data_path):
 
     StderrHandler().push_application()
 
+    logger.info(f"Using the {JSON_BACKEND} JSON backend")
+
     servers = []
     proxies = []
 
@@ -0,0 +1,482 @@
+# Copyright 2019 The Matrix.org Foundation CIC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import json
+import os
+import threading
+from binascii import Error as BinAsciiError
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+from uuid import uuid4
+
+import attr
+import unpaddedbase64
+from Crypto.Cipher import AES
+from Crypto.Util import Counter
+from nio import EncryptionError
+
+from pantalaimon.log import logger
+from pantalaimon.store import MediaInfo
+
+METADATA_SUFFIX = ".json"
+TEMP_SUFFIX = ".tmp"
+
+
+class AttachmentEncryptor:
+    """Encrypt an attachment chunk by chunk.
+
+    This produces the same kind of attachment as nio's encrypt_attachment()
+    without needing the whole file at once. The sha256 hash of the encrypted
+    attachment is computed while the chunks are encrypted, the decryption
+    info is only complete once the last chunk was encrypted.
+    """
+
+    def __init__(self):
+        # type: () -> None
+        self.key = os.urandom(32)
+        # The IV is made out of 8 random bytes and a 8 byte counter starting
+        # at 0.
+        self.iv = os.urandom(8)
+        counter = Counter.new(64, prefix=self.iv, initial_value=0)
+        self.cipher = AES.new(self.key, AES.MODE_CTR, counter=counter)
+        self.hash = hashlib.sha256()
+
+    def encrypt(self, chunk):
+        # type: (bytes) -> bytes
+        """Encrypt the next chunk of the attachment."""
+        encrypted = self.cipher.encrypt(chunk)
+        self.hash.update(encrypted)
+
+        return encrypted
+
+    def decryption_info(self):
+        # type: () -> Dict[str, Any]
+        """Get the key, IV and hash that are needed to decrypt the attachment.
+
+        The dictionary has the same format as the one nio's
+        encrypt_attachment() returns.
+        """
+        return {
+            "v": "v2",
+            "key": {
+                "kty": "oct",
+                "alg": "A256CTR",
+                "ext": True,
+                "k": unpaddedbase64.encode_base64(self.key, urlsafe=True),
+                "key_ops": ["encrypt", "decrypt"],
+            },
+            "iv": unpaddedbase64.encode_base64(self.iv + bytes(8)),
+            "hashes": {"sha256": unpaddedbase64.encode_base64(self.hash.digest())},
+        }
+
+
+class AttachmentDecryptor:
+    """Decrypt an encrypted attachment chunk by chunk.
+
+    This does the same as nio's decrypt_attachment() without needing the
+    whole attachment at once. The sha256 hash of the attachment is computed
+    while the chunks are decrypted, the caller needs to call verify() once
+    the last chunk was decrypted and must not trust the plaintext before
+    that.
+
+    Since AES-CTR is seekable the decryption can start at any offset of the
+    attachment, only the part of the attachment after the offset needs to be
+    passed to decrypt() in that case. The hash of a part of the attachment
+    can't be verified.
+
+    Args:
+        key (str): The unpadded base64 encoded AES-CTR key.
+        hash (str): The unpadded base64 encoded sha256 hash of the
+            attachment.
+        iv (str): The unpadded base64 encoded AES-CTR IV.
+        offset (int): The offset in the attachment where the decryption
+            starts.
+
+    Raises EncryptionError if the key or IV can't be decoded.
+    """
+
+    def __init__(self, key, hash, iv, offset=0):
+        # type: (str, str, str, int) -> None
+        try:
+            self.expected_hash = unpaddedbase64.decode_base64(hash)
+            byte_key = unpaddedbase64.decode_base64(key)
+            byte_iv = unpaddedbase64.decode_base64(iv)
+        except (BinAsciiError, TypeError):
+            raise EncryptionError("Error decoding the key, hash or IV.")
+
+        block, skip = divmod(offset, AES.block_size)
+
+        try:
+            counter = Counter.new(
+                64,
+                prefix=byte_iv[:8],
+                initial_value=int.from_bytes(byte_iv[8:], "big") + block,
+            )
+            self.cipher = AES.new(byte_key, AES.MODE_CTR, counter=counter)
+        except (ValueError, OverflowError) as e:
+            raise EncryptionError(e)
+
+        # Throw away the key stream of the bytes in the first block that come
+        # before the offset.
+        self.cipher.decrypt(bytes(skip))
+
+        self.hash = hashlib.sha256() if offset == 0 else None
+
+    def decrypt(self, chunk):
+        # type: (bytes) -> bytes
+        """Decrypt the next chunk of the attachment."""
+        if self.hash:
+            self.hash.update(chunk)
+
+        return self.cipher.decrypt(chunk)
+
+    def verify(self):
+        # type: () -> None
+        """Check the hash of all the chunks that were decrypted.
+
+        Raises EncryptionError if the hash doesn't match or if the decryption
+        didn't start at the beginning of the attachment.
+        """
+        if not self.hash:
+            raise EncryptionError("Can't verify the hash of a partial attachment.")
+
+        if self.hash.digest() != self.expected_hash:
+            raise EncryptionError("Mismatched SHA-256 digest.")
+
+
+@attr.s
+class CachedMedia:
+    """A media file that was found in the media cache.
+
+    Args:
+        path (str): The path of the cached file.
+        content_type (str): The content type the homeserver returned for the
+            media.
+        encrypted (bool): Is the file stored as the encrypted attachment,
+            otherwise the file contains the decrypted media.
+        size (int): The size of the cached file.
+    """
+
+    path = attr.ib(type=str)
+    content_type = attr.ib(type=str)
+    encrypted = attr.ib(type=bool)
+    size = attr.ib(type=int)
+
+    def read(self):
+        # type: () -> bytes
+        """Read the content of the cached file."""
+        with open(self.path, "rb") as f:
+            return f.read()
+
+
+@attr.s
+class MediaCache:
+    """A size limited on-disk cache for encrypted media.
+
+    Files are addressed by the mxc URI of the media and the sha256 hash of the
+    encrypted attachment, if the attachment is replaced under the same URI the
+    old file will never be served. The least recently used files are evicted
+    once the cache grows larger than its maximum size.
+
+    Every entry consists of a data file with a unique name and a metadata file
+    named after the cache key that points to the data file. The metadata file
+    is replaced atomically once the data file is written, so an entry never
+    pairs the metadata of one write with the data of another one.
+
+    Args:
+        path (str): The directory where the cached files are stored.
+        max_size (int): The maximum size of the cache in bytes.
+        encrypted (bool): Should the encrypted attachment be stored instead of
+            the decrypted media. The attachment will be decrypted every time
+            it's served but no plaintext touches the disk.
+    """
+
+    path = attr.ib(type=str)
+    max_size = attr.ib(type=int)
+    encrypted = attr.ib(type=bool, default=True)
+
+    entries = attr.ib(init=False, default=attr.Factory(OrderedDict))
+    size = attr.ib(init=False, default=0, type=int)
+    lock = attr.ib(init=False, default=attr.Factory(threading.Lock))
+
+    def __attrs_post_init__(self):
+        os.makedirs(self.path, exist_ok=True)
+
+        loaded = []
+        referenced = set()
+
+        for entry in os.scandir(self.path):
+            if not entry.is_file() or not entry.name.endswith(METADATA_SUFFIX):
+                continue
+
+            key = entry.name[: -len(METADATA_SUFFIX)]
+
+            try:
+                with open(entry.path) as f:
+                    metadata = json.load(f)
+
+                data_path = self._file_path(metadata["file"])
+                stat = os.stat(data_path)
+            except (OSError, ValueError, KeyError) as e:
+                logger.warn(f"Removing broken media cache entry {key}: {e}")
+                os.remove(entry.path)
+                continue
+
+            cached = CachedMedia(
+                data_path,
+                metadata["content_type"],
+                metadata["encrypted"],
+                stat.st_size,
+            )
+            loaded.append((stat.st_mtime, key, cached))
+            referenced.add(metadata["file"])
+
+        # Data files that no metadata points to are leftovers of interrupted
+        # or replaced writes.
+        for entry in os.scandir(self.path):
+            if (
+                entry.is_file()
+                and not entry.name.endswith(METADATA_SUFFIX)
+                and entry.name not in referenced
+            ):
+                os.remove(entry.path)
+
+        for _, key, cached in sorted(loaded, key=lambda item: item[0]):
+            self.entries[key] = cached
+            self.size += cached.size
+
+        self._evict()
+
+    @staticmethod
+    def cache_key(media_info):
+        # type: (MediaInfo) -> str
+        """Get the cache key of the given media."""
+        content_hash = media_info.hashes["sha256"]
+        address = f"{media_info.mxc_server}/{media_info.mxc_path}/{content_hash}"
+
+        return hashlib.sha256(address.encode()).hexdigest()
+
+    def _file_path(self, name):
+        return os.path.join(self.path, name)
+
+    def _remove(self, key, cached):
+        for path in (self._file_path(key + METADATA_SUFFIX), cached.path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _evict(self):
+        while self.size > self.max_size and self.entries:
+            key, cached = self.entries.popitem(last=False)
+            self.size -= cached.size
+            logger.debug(f"Evicting {key} from the media cache")
+            self._remove(key, cached)
+
+    def lookup(self, media_info):
+        # type: (MediaInfo) -> Optional[CachedMedia]
+        """Find the cached file for the given media.
+
+        Returns a CachedMedia object if the media is cached, None otherwise.
+
+        This does blocking file IO and should be run in an executor.
+        """
+        key = self.cache_key(media_info)
+
+        with self.lock:
+            cached = self.entries.get(key)
+
+            if not cached:
+                return None
+
+            try:
+                os.utime(cached.path)
+            except OSError as e:
+                logger.warn(f"Error loading {key} from the media cache: {e}")
+                del self.entries[key]
+                self.size -= cached.size
+                self._remove(key, cached)
+                return None
+
+            self.entries.move_to_end(key)
+
+            return cached
+
+    def remove(self, media_info, cached):
+        # type: (MediaInfo, CachedMedia) -> None
+        """Drop a cached file from the cache.
+
+        Nothing is removed if the entry was replaced since the file was looked
+        up.
+
+        This does blocking file IO and should be run in an executor.
+
+        Args:
+            media_info (MediaInfo): The media info of the file.
+            cached (CachedMedia): The cached file that should be dropped.
+        """
+        key = self.cache_key(media_info)
+
+        with self.lock:
+            if self.entries.get(key) is not cached:
+                return
+
+            del self.entries[key]
+            self.size -= cached.size
+            self._remove(key, cached)
+
+    def writer(self, media_info, content_type):
+        # type: (MediaInfo, str) -> MediaCacheWriter
+        """Create a writer that puts a media file into the cache chunk by
+        chunk.
+
+        Args:
+            media_info (MediaInfo): The media info of the file.
+            content_type (str): The content type of the media.
+        """
+        key = self.cache_key(media_info)
+        return MediaCacheWriter(self, key, f"{key}-{uuid4().hex}", content_type)
+
+    def _commit(self, key, cached):
+        metadata_path = self._file_path(key + METADATA_SUFFIX)
+        temp_path = f"{metadata_path}.{uuid4().hex}{TEMP_SUFFIX}"
+
+        with open(temp_path, "w") as f:
+            json.dump(
+                {
+                    "file": os.path.basename(cached.path),
+                    "content_type": cached.content_type,
+                    "encrypted": cached.encrypted,
+                },
+                f,
+            )
+
+        with self.lock:
+            os.replace(temp_path, metadata_path)
+
+            old = self.entries.pop(key, None)
+
+            if old:
+                self.size -= old.size
+
+                try:
+                    os.remove(old.path)
+                except FileNotFoundError:
+                    pass
+
+            self.entries[key] = cached
+            self.size += cached.size
+            self._evict()
+
+    def store(self, media_info, attachment, decrypted, content_type):
+        # type: (MediaInfo, bytes, bytes, str) -> None
+        """Put a media file into the cache.
+
+        This does blocking file IO and should be run in an executor.
+
+        Args:
+            media_info (MediaInfo): The media info of the file.
+            attachment (bytes): The encrypted attachment, stored if the cache
+                is encrypted.
+            decrypted (bytes): The decrypted media, stored if the cache isn't
+                encrypted.
+            content_type (str): The content type of the media.
+        """
+        writer = self.writer(media_info, content_type)
+
+        try:
+            writer.write(attachment, decrypted)
+            writer.commit()
+        except BaseException:
+            writer.discard()
+            raise
+
+
+class MediaCacheWriter:
+    """Write a media file into the cache chunk by chunk.
+
+    The file only becomes part of the cache once commit() is called, a file
+    that grows larger than the whole cache is dropped.
+
+    Args:
+        cache (MediaCache): The cache the file belongs to.
+        key (str): The cache key of the media.
+        file_name (str): The name of the data file.
+        content_type (str): The content type of the media.
+    """
+
+    def __init__(self, cache, key, file_name, content_type):
+        # type: (MediaCache, str, str, str) -> None
+        self.cache = cache
+        self.key = key
+        self.path = cache._file_path(file_name)
+        self.content_type = content_type
+        self.size = 0
+        self.file = open(self.path, "wb")
+
+    def write(self, attachment, decrypted):
+        # type: (bytes, bytes) -> None
+        """Write the next chunk of the media.
+
+        Args:
+            attachment (bytes): The chunk of the encrypted attachment.
+            decrypted (bytes): The same chunk decrypted.
+        """
+        if not self.file:
+            return
+
+        data = attachment if self.cache.encrypted else decrypted
+        self.size += len(data)
+
+        if self.size > self.cache.max_size:
+            self.discard()
+            return
+
+        self.file.write(data)
+
+    def commit(self):
+        # type: () -> None
+        """Add the written file to the cache."""
+        if not self.file:
+            return
+
+        self.file.close()
+        self.file = None
+
+        cached = CachedMedia(
+            self.path, self.content_type, self.cache.encrypted, self.size
+        )
+
+        try:
+            self.cache._commit(self.key, cached)
+        except BaseException:
+            self._remove_file()
+            raise
+
+    def discard(self):
+        # type: () -> None
+        """Throw the written data away."""
+        if not self.file:
+            return
+
+        self.file.close()
+        self.file = None
+        self._remove_file()
+
+    def _remove_file(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
@@ -12,28 +12,149 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import json
+import asyncio
 import os
+import threading
 from collections import defaultdict
-from typing import Any, Dict, List, Optional, Tuple
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, wraps
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
 
 import attr
-from nio.crypto import TrustState, GroupSessionStore
+from nio.crypto import GroupSessionStore, InboundGroupSession, TrustState
 from nio.store import (
     Accounts,
+    ForwardedChains,
     MegolmInboundSessions,
     DeviceKeys,
     SqliteStore,
     DeviceTrustState,
-    use_database,
-    use_database_atomic,
 )
-from peewee import SQL, DoesNotExist, ForeignKeyField, Model, SqliteDatabase, TextField
+from peewee import (
+    EXCLUDED,
+    SQL,
+    DoesNotExist,
+    ForeignKeyField,
+    Model,
+    SqliteDatabase,
+    TextField,
+    chunked,
+)
 from cachetools import LRUCache
 
+from pantalaimon.codec import dumps, loads
+from pantalaimon.log import logger
+
 MAX_LOADED_MEDIA = 10000
 MAX_LOADED_UPLOAD = 10000
 
+# The number of the most recently added entries that are loaded into the
+# media and upload caches at startup.
+PREWARMED_MEDIA = 1000
+PREWARMED_UPLOAD = 1000
+
+# The number of seconds sync tokens and media info are held back before they
+# are written to the database.
+WRITE_BEHIND_INTERVAL = 1.0
+
+# The number of Megolm sessions that are written with a single statement, this
+# keeps the statements below the SQLite limit of bound variables.
+SESSION_BATCH_SIZE = 100
+
+# The SQLite pragmas of the storage profiles that can be selected with the
+# StorageProfile option.
+STORAGE_PROFILES = {
+    "default": {"foreign_keys": 1, "secure_delete": 1},
+    "wal": {
+        "foreign_keys": 1,
+        "secure_delete": 1,
+        "journal_mode": "wal",
+        # With write-ahead logging a commit doesn't need to wait for a sync
+        # to stay consistent, only the last commits can get lost on a power
+        # failure.
+        "synchronous": "normal",
+        "cache_size": -16 * 1024,
+        "mmap_size": 64 * 1024 * 1024,
+        "temp_store": "memory",
+        "busy_timeout": 5000,
+    },
+}
+
+
+# Peewee binds models to a database for the whole process, not per thread.
+# The stores are used from the event loop, the store thread and the threads
+# that restore clients, so binding models is serialized with this lock.
+BIND_LOCK = threading.RLock()
+
+
+class LockedSqliteDatabase(SqliteDatabase):
+    """A SQLite database that holds the bind lock while models are bound to
+    it."""
+
+    @contextmanager
+    def bind_ctx(self, models, bind_refs=True, bind_backrefs=True):
+        with BIND_LOCK, super().bind_ctx(models, bind_refs, bind_backrefs):
+            yield
+
+
+def use_database(fn):
+    """Bind the models of the store to its database while the wrapped method
+    runs."""
+
+    @wraps(fn)
+    def inner(self, *args, **kwargs):
+        with self.database.bind_ctx(self.models):
+            return fn(self, *args, **kwargs)
+
+    return inner
+
+
+def use_pan_database(fn):
+    """Like use_database but only the tables that belong to pantalaimon are
+    bound.
+
+    Methods that run on the store thread use this so they don't touch the
+    tables that are shared with the nio stores.
+    """
+
+    @wraps(fn)
+    def inner(self, *args, **kwargs):
+        with self.database.bind_ctx(self.pan_models):
+            return fn(self, *args, **kwargs)
+
+    return inner
+
+
+def use_pan_database_atomic(fn):
+    """Like use_pan_database but the wrapped method runs in a transaction."""
+
+    @wraps(fn)
+    def inner(self, *args, **kwargs):
+        with self.database.bind_ctx(self.pan_models):
+            with self.database.atomic():
+                return fn(self, *args, **kwargs)
+
+    return inner
+
+
+def profiled_store_class(store_class, storage_profile):
+    """Create a subclass of a nio store class that opens its database with
+    the pragmas of the given storage profile.
+
+    Args:
+        store_class (MatrixStore): The nio store class that should be used.
+        storage_profile (str): The name of the storage profile.
+    """
+    pragmas = STORAGE_PROFILES[storage_profile]
+
+    def _create_database(self):
+        return LockedSqliteDatabase(self.database_path, pragmas=pragmas)
+
+    return type(
+        store_class.__name__, (store_class,), {"_create_database": _create_database}
+    )
+
 
 @attr.s
 class FetchTask:
@@ -79,10 +200,10 @@ class UploadInfo:
 
 class DictField(TextField):
     def python_value(self, value):  # pragma: no cover
-        return json.loads(value)
+        return loads(value)
 
     def db_value(self, value):  # pragma: no cover
-        return json.dumps(value)
+        return dumps(value)
 
 
 class AccessTokens(Model):
@@ -154,6 +275,20 @@ class PanUploadInfo(Model):
         constraints = [SQL("UNIQUE(server_id, content_uri)")]
 
 
+class PanDecryptedUploads(Model):
+    server = ForeignKeyField(
+        model=Servers,
+        column_name="server_id",
+        backref="decrypted_uploads",
+        on_delete="CASCADE",
+    )
+    content_uri = TextField()
+    decrypted_content_uri = TextField()
+
+    class Meta:
+        constraints = [SQL("UNIQUE(server_id, content_uri)")]
+
+
 @attr.s
 class ClientInfo:
     user_id = attr.ib(type=str)
@@ -164,20 +299,37 @@ class ClientInfo:
 class PanStore:
     store_path = attr.ib(type=str)
     database_name = attr.ib(type=str, default="pan.db")
+    storage_profile = attr.ib(type=str, default="default")
+    flush_interval = attr.ib(type=float, default=WRITE_BEHIND_INTERVAL)
     database = attr.ib(type=SqliteDatabase, init=False)
     database_path = attr.ib(type=str, init=False)
-    models = [
-        Accounts,
-        AccessTokens,
+
+    # Writes that are waiting for the next flush.
+    pending_tokens = attr.ib(init=False, factory=dict)
+    pending_media = attr.ib(init=False, factory=dict)
+    pending_lock = attr.ib(init=False, factory=threading.Lock)
+    flush_lock = attr.ib(init=False, factory=threading.Lock)
+    flush_thread = attr.ib(init=False, default=None)
+    closing = attr.ib(init=False, factory=threading.Event)
+
+    # The row ids of the Servers and ServerUsers rows, those rows are never
+    # removed so the ids can be cached for the lifetime of the store.
+    server_ids = attr.ib(init=False, factory=dict)
+    server_user_ids = attr.ib(init=False, factory=dict)
+
+    aio = attr.ib(init=False)
+
+    # The tables that only pantalaimon uses.
+    pan_models = [
         Servers,
         ServerUsers,
-        DeviceKeys,
-        DeviceTrustState,
         PanSyncTokens,
         PanFetcherTasks,
         PanMediaInfo,
         PanUploadInfo,
+        PanDecryptedUploads,
     ]
+    models = [Accounts, AccessTokens, DeviceKeys, DeviceTrustState] + pan_models
 
     def __attrs_post_init__(self):
         self.database_path = os.path.join(
@@ -186,15 +338,179 @@ class PanStore:
 
         self.database = self._create_database()
         self.database.connect()
+        self.aio = AsyncPanStore(self)
 
         with self.database.bind_ctx(self.models):
             self.database.create_tables(self.models)
 
+            for server in Servers.select():
+                self.server_ids[server.name] = server.id
+
+            query = ServerUsers.select(
+                ServerUsers.id, ServerUsers.user_id, Servers.name
+            ).join(Servers)
+
+            for user in query:
+                self.server_user_ids[(user.server.name, user.user_id)] = user.id
+
     def _create_database(self):
-        return SqliteDatabase(
-            self.database_path, pragmas={"foreign_keys": 1, "secure_delete": 1}
+        return LockedSqliteDatabase(
+            self.database_path, pragmas=STORAGE_PROFILES[self.storage_profile]
         )
 
+    def _server_id(self, server_name, create=False, database=None):
+        """Get the row id of a server.
+
+        Args:
+            server_name (str): The name of the server.
+            create (bool): Should the server be added if it isn't stored yet.
+            database (SqliteDatabase, optional): The database the query
+                should run on if the models aren't bound.
+
+        Raises DoesNotExist if the server isn't stored and create is False.
+        """
+        try:
+            return self.server_ids[server_name]
+        except KeyError:
+            pass
+
+        if create:
+            server, _ = Servers.get_or_create(name=server_name)
+        else:
+            server = Servers.select().where(Servers.name == server_name).get(database)
+
+        self.server_ids[server_name] = server.id
+
+        return server.id
+
+    def _server_user_id(self, server_name, user_id, database=None):
+        """Get the row id of a server user.
+
+        Args:
+            server_name (str): The name of the server the user belongs to.
+            user_id (str): The user id of the user.
+            database (SqliteDatabase, optional): The database the query
+                should run on if the models aren't bound.
+
+        Raises DoesNotExist if the user isn't stored.
+        """
+        try:
+            return self.server_user_ids[(server_name, user_id)]
+        except KeyError:
+            pass
+
+        user = (
+            ServerUsers.select()
+            .where(
+                ServerUsers.server == self._server_id(server_name, database=database),
+                ServerUsers.user_id == user_id,
+            )
+            .get(database)
+        )
+
+        self.server_user_ids[(server_name, user_id)] = user.id
+
+        return user.id
+
+    def _queue_write(self, pending, key, value):
+        with self.pending_lock:
+            pending[key] = value
+
+            if not self.flush_thread:
+                self.flush_thread = threading.Thread(
+                    target=self._flush_loop, name="PanStore writer", daemon=True
+                )
+                self.flush_thread.start()
+
+    def _flush_loop(self):
+        while not self.closing.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Error writing to the store, retrying later: {e}")
+
+    def flush(self):
+        # type: () -> None
+        """Write the queued sync tokens and media info to the database.
+
+        All the queued writes are done in a single transaction. This is called
+        periodically from a background thread, it only needs to be called
+        directly if the writes need to be on the disk right away.
+        """
+        with self.flush_lock:
+            with self.pending_lock:
+                tokens = dict(self.pending_tokens)
+                media = dict(self.pending_media)
+
+            if not tokens and not media:
+                return
+
+            # The flush might run on the writer thread while the event loop
+            # binds the models to a database, so the database is passed to
+            # every query explicitly instead of binding the models here.
+            database = self.database
+
+            with database.atomic():
+                for (server_name, user_id), token in tokens.items():
+                    try:
+                        user = self._server_user_id(server_name, user_id, database)
+                    except DoesNotExist:
+                        # The user was removed since the token was queued.
+                        continue
+
+                    PanSyncTokens.replace(user=user, token=token).execute(database)
+
+                rows = []
+
+                for (server_name, _, _), info in media.items():
+                    try:
+                        server = self._server_id(server_name, database=database)
+                    except DoesNotExist:
+                        logger.warn(
+                            f"Dropping media info for unknown server {server_name}"
+                        )
+                        continue
+
+                    rows.append(
+                        {
+                            "server": server,
+                            "mxc_server": info.mxc_server,
+                            "mxc_path": info.mxc_path,
+                            "key": info.key,
+                            "iv": info.iv,
+                            "hashes": info.hashes,
+                        }
+                    )
+
+                for batch in chunked(rows, 100):
+                    PanMediaInfo.insert_many(batch).on_conflict_ignore().execute(
+                        database
+                    )
+
+            # Only forget the writes that weren't replaced while we were
+            # writing them.
+            with self.pending_lock:
+                for pending, written in (
+                    (self.pending_tokens, tokens),
+                    (self.pending_media, media),
+                ):
+                    for key, value in written.items():
+                        if pending.get(key) is value:
+                            del pending[key]
+
+    def close(self):
+        # type: () -> None
+        """Write out all the queued writes and stop the writer and store
+        threads."""
+        self.aio.close()
+        self.closing.set()
+
+        if self.flush_thread:
+            self.flush_thread.join()
+            self.flush_thread = None
+
+        self.flush()
+
     @use_database
     def _get_account(self, user_id, device_id):
         try:
@@ -204,9 +520,9 @@ class PanStore:
         except DoesNotExist:
             return None
 
-    @use_database
+    @use_pan_database
     def save_upload(self, server, content_uri, filename, mimetype):
-        server = Servers.get(name=server)
+        server = self._server_id(server)
 
         PanUploadInfo.insert(
             server=server,
@@ -215,21 +531,27 @@ class PanStore:
             mimetype=mimetype,
         ).on_conflict_ignore().execute()
 
-    @use_database
+    @use_pan_database
     def load_upload(self, server, content_uri=None):
-        server, _ = Servers.get_or_create(name=server)
+        """Load the upload info of a file.
 
-        if not content_uri:
-            upload_cache = LRUCache(maxsize=MAX_LOADED_UPLOAD)
-
-            for i, u in enumerate(server.upload):
-                if i > MAX_LOADED_UPLOAD:
-                    break
+        If no content URI is given the most recently added upload infos are
+        loaded, ordered from the oldest to the newest one.
+        """
+        server = self._server_id(server, create=True)
 
-                upload = UploadInfo(u.content_uri, u.filename, u.mimetype)
-                upload_cache[u.content_uri] = upload
+        if not content_uri:
+            query = (
+                PanUploadInfo.select()
+                .where(PanUploadInfo.server == server)
+                .order_by(PanUploadInfo.id.desc())
+                .limit(PREWARMED_UPLOAD)
+            )
 
-            return upload_cache
+            return {
+                u.content_uri: UploadInfo(u.content_uri, u.filename, u.mimetype)
+                for u in reversed(list(query))
+            }
         else:
             u = PanUploadInfo.get_or_none(
                 PanUploadInfo.server == server,
@@ -241,36 +563,94 @@ class PanStore:
 
             return UploadInfo(u.content_uri, u.filename, u.mimetype)
 
-    @use_database
-    def save_media(self, server, media):
-        server = Servers.get(name=server)
+    @use_pan_database
+    def save_decrypted_upload(self, server, content_uri, decrypted_content_uri):
+        server = self._server_id(server)
 
-        PanMediaInfo.insert(
+        PanDecryptedUploads.replace(
             server=server,
-            mxc_server=media.mxc_server,
-            mxc_path=media.mxc_path,
-            key=media.key,
-            iv=media.iv,
-            hashes=media.hashes,
-        ).on_conflict_ignore().execute()
+            content_uri=content_uri,
+            decrypted_content_uri=decrypted_content_uri,
+        ).execute()
 
-    @use_database
-    def load_media_cache(self, server):
-        server, _ = Servers.get_or_create(name=server)
-        media_cache = LRUCache(maxsize=MAX_LOADED_MEDIA)
+    @use_pan_database
+    def load_decrypted_uploads(self, server, content_uri=None):
+        """Load the URI of the plaintext copy of an encrypted upload.
 
-        for i, m in enumerate(server.media):
-            if i > MAX_LOADED_MEDIA:
-                break
+        If no content URI is given the most recently added copies are loaded,
+        ordered from the oldest to the newest one.
+        """
+        server = self._server_id(server, create=True)
 
-            media = MediaInfo(m.mxc_server, m.mxc_path, m.key, m.iv, m.hashes)
-            media_cache[(m.mxc_server, m.mxc_path)] = media
+        if not content_uri:
+            query = (
+                PanDecryptedUploads.select()
+                .where(PanDecryptedUploads.server == server)
+                .order_by(PanDecryptedUploads.id.desc())
+                .limit(PREWARMED_UPLOAD)
+            )
 
-        return media_cache
+            return {
+                u.content_uri: u.decrypted_content_uri for u in reversed(list(query))
+            }
+        else:
+            u = PanDecryptedUploads.get_or_none(
+                PanDecryptedUploads.server == server,
+                PanDecryptedUploads.content_uri == content_uri,
+            )
 
-    @use_database
+            if not u:
+                return None
+
+            return u.decrypted_content_uri
+
+    def save_media(self, server, media):
+        # type: (str, MediaInfo) -> None
+        """Queue the media info of an encrypted file to be saved.
+
+        The media info is written to the database with the next flush, if the
+        media info for the file is already stored it's left as it is.
+        """
+        key = (server, media.mxc_server, media.mxc_path)
+
+        with self.pending_lock:
+            if key in self.pending_media:
+                return
+
+        self._queue_write(self.pending_media, key, media)
+
+    @use_pan_database
+    def load_media_cache(self, server):
+        """Load the most recently added media infos.
+
+        The media infos are ordered from the oldest to the newest one.
+        """
+        self.flush()
+
+        server = self._server_id(server, create=True)
+        query = (
+            PanMediaInfo.select()
+            .where(PanMediaInfo.server == server)
+            .order_by(PanMediaInfo.id.desc())
+            .limit(PREWARMED_MEDIA)
+        )
+
+        return {
+            (m.mxc_server, m.mxc_path): MediaInfo(
+                m.mxc_server, m.mxc_path, m.key, m.iv, m.hashes
+            )
+            for m in reversed(list(query))
+        }
+
+    @use_pan_database
     def load_media(self, server, mxc_server=None, mxc_path=None):
-        server, _ = Servers.get_or_create(name=server)
+        with self.pending_lock:
+            media = self.pending_media.get((server, mxc_server, mxc_path))
+
+        if media:
+            return media
+
+        server = self._server_id(server, create=True)
 
         m = PanMediaInfo.get_or_none(
             PanMediaInfo.server == server,
@@ -283,10 +663,9 @@ class PanStore:
 
         return MediaInfo(m.mxc_server, m.mxc_path, m.key, m.iv, m.hashes)
 
-    @use_database_atomic
+    @use_pan_database_atomic
     def replace_fetcher_task(self, server, pan_user, old_task, new_task):
-        server = Servers.get(name=server)
-        user = ServerUsers.get(server=server, user_id=pan_user)
+        user = self._server_user_id(server, pan_user)
 
         PanFetcherTasks.delete().where(
             PanFetcherTasks.user == user,
@@ -298,31 +677,28 @@ class PanStore:
             user=user, room_id=new_task.room_id, token=new_task.token
         ).execute()
 
-    @use_database
+    @use_pan_database
     def save_fetcher_task(self, server, pan_user, task):
-        server = Servers.get(name=server)
-        user = ServerUsers.get(server=server, user_id=pan_user)
+        user = self._server_user_id(server, pan_user)
 
         PanFetcherTasks.replace(
             user=user, room_id=task.room_id, token=task.token
         ).execute()
 
-    @use_database
+    @use_pan_database
     def load_fetcher_tasks(self, server, pan_user):
-        server = Servers.get(name=server)
-        user = ServerUsers.get(server=server, user_id=pan_user)
+        user = self._server_user_id(server, pan_user)
 
         tasks = []
 
-        for t in user.fetcher_tasks:
+        for t in PanFetcherTasks.select().where(PanFetcherTasks.user == user):
             tasks.append(FetchTask(t.room_id, t.token))
 
         return tasks
 
-    @use_database
+    @use_pan_database
     def delete_fetcher_task(self, server, pan_user, task):
-        server = Servers.get(name=server)
-        user = ServerUsers.get(server=server, user_id=pan_user)
+        user = self._server_user_id(server, pan_user)
 
         PanFetcherTasks.delete().where(
             PanFetcherTasks.user == user,
@@ -330,24 +706,29 @@ class PanStore:
             PanFetcherTasks.token == task.token,
         ).execute()
 
-    @use_database
     def save_token(self, server, pan_user, token):
         # type: (str, str, str) -> None
-        """Save a sync token for a pan user."""
-        server = Servers.get(name=server)
-        user = ServerUsers.get(server=server, user_id=pan_user)
+        """Queue a sync token for a pan user to be saved.
 
-        PanSyncTokens.replace(user=user, token=token).execute()
+        Only the last token that was queued for a user before the next flush
+        is written to the database.
+        """
+        self._queue_write(self.pending_tokens, (server, pan_user), token)
 
-    @use_database
+    @use_pan_database
     def load_token(self, server, pan_user):
         # type: (str, str) -> Optional[str]
         """Load a sync token for a pan user.
 
         Returns the sync token if one is found.
         """
-        server = Servers.get(name=server)
-        user = ServerUsers.get(server=server, user_id=pan_user)
+        with self.pending_lock:
+            token = self.pending_tokens.get((server, pan_user))
+
+        if token:
+            return token
+
+        user = self._server_user_id(server, pan_user)
 
         token = PanSyncTokens.get_or_none(user=user)
 
@@ -356,15 +737,17 @@ class PanStore:
 
         return None
 
-    @use_database
+    @use_pan_database
     def save_server_user(self, server_name, user_id):
         # type: (str, str) -> None
-        server, _ = Servers.get_or_create(name=server_name)
+        server = self._server_id(server_name, create=True)
 
         ServerUsers.insert(
             user_id=user_id, server=server
         ).on_conflict_ignore().execute()
 
+        self._server_user_id(server_name, user_id)
+
     @use_database
     def load_all_users(self):
         users = []
@@ -456,24 +839,198 @@ class PanStore:
         return store
 
 
-class KeyDroppingSqliteStore(SqliteStore):
-    @use_database
+class ReadThroughCache:
+    """A bounded cache for entries of the store.
+
+    Entries that aren't cached are looked up in the store when they are
+    requested, the least recently used entries are evicted once the cache is
+    full. The number of hits and misses is counted, the daemon logs them on
+    shutdown.
+
+    Args:
+        maxsize (int): The maximum number of cached entries.
+        load (Callable): A coroutine function that looks an entry up in the
+            store, it's called with the key of the entry and returns None if
+            the entry doesn't exist.
+    """
+
+    def __init__(self, maxsize, load):
+        # type: (int, Callable[[Any], Awaitable[Any]]) -> None
+        self.entries = LRUCache(maxsize=maxsize)
+        self.load = load
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, key):
+        """Get the entry for the given key, loading it if it isn't cached.
+
+        Returns None if the entry doesn't exist.
+        """
+        try:
+            value = self.entries[key]
+        except KeyError:
+            self.misses += 1
+        else:
+            self.hits += 1
+            return value
+
+        value = await self.load(key)
+
+        if value is not None:
+            self.entries[key] = value
+
+        return value
+
+    def update(self, entries):
+        # type: (Dict[Any, Any]) -> None
+        """Add the given entries to the cache."""
+        self.entries.update(entries)
+
+    def __getitem__(self, key):
+        return self.entries[key]
+
+    def __setitem__(self, key, value):
+        self.entries[key] = value
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class AsyncPanStore:
+    """Run the methods of a PanStore on a dedicated thread.
+
+    Every method of the PanStore is available as a coroutine function that
+    runs the method on the store thread, so the event loop doesn't block on
+    the database. Only methods that use the tables of pantalaimon can be
+    called this way, see use_pan_database.
+
+    Args:
+        store (PanStore): The store whose methods should be run.
+    """
+
+    def __init__(self, store):
+        # type: (PanStore) -> None
+        self.store = store
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="PanStore")
+
+    def __getattr__(self, name):
+        if name in ("store", "executor"):
+            raise AttributeError(name)
+
+        method = getattr(self.store, name)
+
+        async def run(*args, **kwargs):
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(
+                self.executor, partial(method, *args, **kwargs)
+            )
+
+        return run
+
+    def close(self):
+        # type: () -> None
+        """Wait for the running calls and stop the store thread."""
+        self.executor.shutdown(wait=True)
+
+
+class BatchedSqliteStore(SqliteStore):
+    """A nio SQLite store that can save many Megolm sessions in one
+    transaction.
+
+    Sessions that are saved inside of a batch_session_saves() block are
+    written out when the block is left.
+    """
+
+    drop_old_keys = False
+    _session_batch = None  # type: Optional[List[InboundGroupSession]]
+
+    @contextmanager
+    def batch_session_saves(self):
+        """Collect the Megolm sessions that are saved while the context is
+        active and save them all at once at the end."""
+        if self._session_batch is not None:
+            yield
+            return
+
+        self._session_batch = []
+
+        try:
+            yield
+        finally:
+            sessions, self._session_batch = self._session_batch, None
+
+            if sessions:
+                self.save_inbound_group_sessions(sessions)
+
     def save_inbound_group_session(self, session):
         """Save the provided Megolm inbound group session to the database.
 
         Args:
             session (InboundGroupSession): The session to save.
         """
+        if self._session_batch is not None:
+            self._session_batch.append(session)
+        else:
+            self.save_inbound_group_sessions([session])
+
+    @use_database
+    def save_inbound_group_sessions(self, sessions):
+        """Save the provided Megolm inbound group sessions to the database in
+        a single transaction.
+
+        Args:
+            sessions (List[InboundGroupSession]): The sessions to save.
+        """
         account = self._get_account()
         assert account
 
-        MegolmInboundSessions.delete().where(
-            MegolmInboundSessions.sender_key == session.sender_key,
-            MegolmInboundSessions.account == account,
-            MegolmInboundSessions.room_id == session.room_id,
-        ).execute()
+        if self.drop_old_keys:
+            # Only the newest session of every room and sender survives.
+            sessions = list({(s.room_id, s.sender_key): s for s in sessions}.values())
+
+        session_rows = []
+        chain_rows = []
+
+        for session in sessions:
+            session_rows.append(
+                {
+                    "sender_key": session.sender_key,
+                    "account": account,
+                    "fp_key": session.ed25519,
+                    "room_id": session.room_id,
+                    "session": session.pickle(self.pickle_key),
+                    "session_id": session.id,
+                }
+            )
+            chain_rows.extend(
+                {"sender_key": chain, "session": session.id}
+                for chain in session.forwarding_chain
+            )
+
+        with self.database.atomic():
+            if self.drop_old_keys:
+                for session in sessions:
+                    MegolmInboundSessions.delete().where(
+                        MegolmInboundSessions.sender_key == session.sender_key,
+                        MegolmInboundSessions.account == account,
+                        MegolmInboundSessions.room_id == session.room_id,
+                    ).execute()
+
+            for batch in chunked(session_rows, SESSION_BATCH_SIZE):
+                MegolmInboundSessions.insert_many(batch).on_conflict(
+                    conflict_target=[MegolmInboundSessions.session_id],
+                    update={MegolmInboundSessions.session: EXCLUDED.session},
+                ).execute()
+
+            for batch in chunked(chain_rows, SESSION_BATCH_SIZE):
+                ForwardedChains.replace_many(batch).execute()
+
 
-        super().save_inbound_group_session(session)
+class KeyDroppingSqliteStore(BatchedSqliteStore):
+    drop_old_keys = True
 
     @use_database
     def load_inbound_group_sessions(self):
@@ -498,3 +1055,131 @@ class KeyDroppingGroupSessionStore(GroupSessionStore):
         self._entries[room_id][sender_key].clear()
         self._entries[room_id][sender_key][session.id] = session
         return True
+
+
+class LazyGroupSessionStore(GroupSessionStore):
+    """A group session store that loads Megolm sessions on demand.
+
+    Sessions are looked up in the database of the client store the first time
+    they are needed to decrypt an event, only a bounded number of the most
+    recently used sessions is kept in memory. Sessions that were looked up but
+    don't exist are remembered until they are added.
+
+    Args:
+        store (MatrixStore): The client store that holds the sessions.
+        max_sessions (int): The maximum number of sessions kept in memory.
+        drop_old_keys (bool): Should only the newest session of every room and
+            sender be kept, like the KeyDroppingGroupSessionStore does.
+    """
+
+    def __init__(self, store, max_sessions, drop_old_keys=False):
+        super().__init__()
+        self.store = store
+        self.drop_old_keys = drop_old_keys
+        self.sessions = LRUCache(maxsize=max_sessions)
+        self.missing = LRUCache(maxsize=max_sessions)
+        self.account = None
+
+    def _from_row(self, row):
+        return InboundGroupSession.from_pickle(
+            row.session,
+            row.fp_key,
+            row.sender_key,
+            row.room_id,
+            self.store.pickle_key,
+            [chain.sender_key for chain in row.forwarded_chains],
+        )
+
+    def _load(self, *conditions):
+        with self.store.database.bind_ctx(self.store.models):
+            if not self.account:
+                self.account = self.store._get_account()
+
+            query = MegolmInboundSessions.select().where(
+                MegolmInboundSessions.account == self.account, *conditions
+            )
+
+            return [self._from_row(row) for row in query]
+
+    def get(self, room_id, sender_key, session_id):
+        # type: (str, str, str) -> Optional[InboundGroupSession]
+        key = (room_id, sender_key, session_id)
+
+        try:
+            return self.sessions[key]
+        except KeyError:
+            pass
+
+        if key in self.missing:
+            return None
+
+        sessions = self._load(
+            MegolmInboundSessions.session_id == session_id,
+            MegolmInboundSessions.room_id == room_id,
+            MegolmInboundSessions.sender_key == sender_key,
+        )
+
+        if not sessions:
+            self.missing[key] = True
+            return None
+
+        self.sessions[key] = sessions[0]
+
+        return sessions[0]
+
+    def add(self, session):
+        # type: (InboundGroupSession) -> bool
+        key = (session.room_id, session.sender_key, session.id)
+
+        if self.sessions.get(key) is session:
+            return False
+
+        if self.drop_old_keys:
+            for old_key in list(self.sessions):
+                if old_key[:2] == key[:2]:
+                    del self.sessions[old_key]
+
+        self.missing.pop(key, None)
+        self.sessions[key] = session
+
+        return True
+
+    def __iter__(self):
+        # The stored sessions are the same as the ones in memory, except for
+        # sessions that were added but not saved yet.
+        stored = self._load()
+        ids = {session.id for session in stored}
+
+        yield from stored
+        yield from (s for s in self.sessions.values() if s.id not in ids)
+
+    def __getitem__(self, room_id):
+        entries = defaultdict(dict)
+
+        for session in self._load(MegolmInboundSessions.room_id == room_id):
+            key = (session.room_id, session.sender_key, session.id)
+            session = self.sessions.get(key, session)
+            entries[session.sender_key][session.id] = session
+
+        return entries
+
+
+def lazy_session_store_class(store_class, max_sessions):
+    """Create a subclass of a nio store class that loads Megolm sessions on
+    demand.
+
+    Args:
+        store_class (MatrixStore): The nio store class that should be used.
+        max_sessions (int): The maximum number of Megolm sessions that are
+            kept in memory.
+    """
+    drop_old_keys = issubclass(store_class, KeyDroppingSqliteStore)
+
+    def load_inbound_group_sessions(self):
+        return LazyGroupSessionStore(self, max_sessions, drop_old_keys)
+
+    return type(
+        store_class.__name__,
+        (store_class,),
+        {"load_inbound_group_sessions": load_inbound_group_sessions},
+    )
@@ -29,9 +29,12 @@ setup(
         "cachetools >= 3.0.0",
         "prompt_toolkit > 2, < 4",
         "typing;python_version<'3.5'",
-        "matrix-nio[e2e] >= 0.20, < 0.21"
+        "matrix-nio[e2e] >= 0.20, < 0.21",
+        "pycryptodome >= 3.10",
+        "unpaddedbase64 >= 2.1",
     ],
     extras_require={
+        "json": ["orjson >= 3.0"],
         "ui": [
             "dbus-python >= 1.2, < 1.3",
             "PyGObject >= 3.36, < 3.39",
@@ -0,0 +1,38 @@
+import json
+
+import pytest
+
+from pantalaimon.codec import (
+    JSONDecodeError,
+    dumps,
+    dumps_bytes,
+    json_response,
+    loads,
+)
+
+
+def test_roundtrip():
+    content = {"body": "Hello ✨", "url": "mxc://localhost/media", "size": 1}
+
+    assert loads(dumps(content)) == content
+    assert json.loads(dumps(content)) == content
+
+
+def test_sorted_keys():
+    assert dumps_bytes({"b": 1, "a": {"d": 2, "c": 3}}, sort_keys=True) == (
+        dumps_bytes({"a": {"c": 3, "d": 2}, "b": 1}, sort_keys=True)
+    )
+    assert loads(dumps_bytes({"b": 1, "a": 2}, sort_keys=True)) == {"a": 2, "b": 1}
+
+
+def test_invalid_json():
+    with pytest.raises(JSONDecodeError):
+        loads("{")
+
+
+def test_json_response():
+    response = json_response({"errcode": "M_NOT_JSON"}, status=400)
+
+    assert response.status == 400
+    assert response.content_type == "application/json"
+    assert loads(response.body) == {"errcode": "M_NOT_JSON"}
@@ -144,7 +144,13 @@ async def pan_proxy_server(tempdir, aiohttp_server):
         web.post("/_matrix/client/r0/user/{user_id}/filter", proxy.filter),
         web.post("/_matrix/client/r0/search", proxy.search),
         web.options("/_matrix/client/r0/search", proxy.search_opts),
+        web.get(
+            "/_matrix/media/r0/download/{server_name}/{media_id}",
+            proxy.download,
+        ),
+        web.post("/_matrix/media/r0/upload", proxy.upload),
     ])
+    app.router.add_route("*", "/" + "{proxyPath:.*}", proxy.router)
 
     server = await aiohttp_server(app)
 
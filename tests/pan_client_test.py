@@ -1,5 +1,8 @@
+import asyncio
 import os
 import re
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
 
 import janus
 import pytest
@@ -9,7 +12,7 @@ from nio import (
     KeysUploadResponse,
     SyncResponse,
 )
-from nio.crypto import Olm, OlmDevice
+from nio.crypto import InboundGroupSession, Olm, OlmDevice
 from nio.store import SqliteMemoryStore
 from nio.store import SqliteStore
 
@@ -602,3 +605,176 @@ class TestClass(object):
             TEST_ROOM_ID, bob_device.curve25519, outbound_session.id
         )
         assert session
+
+    async def _receive_room_key(self, client):
+        """Let Bob share a room key with the client, returns Bob's Olm machine."""
+        await client.receive_response(self.login_response)
+        await client.receive_response(
+            SyncResponse.from_dict(self.initial_sync_response)
+        )
+        await client.receive_response(
+            KeysUploadResponse.from_dict(self.keys_upload_response)
+        )
+        await client.receive_response(
+            KeysQueryResponse.from_dict(self.keys_query_response)
+        )
+
+        bob_olm = Olm(
+            "@bob:example.org", "BOBDEVICE", SqliteMemoryStore("ephemeral", "DEVICEID")
+        )
+
+        alice_device = OlmDevice(
+            client.user_id, client.device_id, client.olm.account.identity_keys
+        )
+        bob_device = OlmDevice(
+            bob_olm.user_id, bob_olm.device_id, bob_olm.account.identity_keys
+        )
+
+        client.olm.device_store.add(bob_device)
+        bob_olm.device_store.add(alice_device)
+        bob_olm.store.save_device_keys(
+            {client.user_id: {client.device_id: alice_device}}
+        )
+
+        client.olm.account.generate_one_time_keys(1)
+        one_time = list(client.olm.account.one_time_keys["curve25519"].values())[0]
+        client.olm.account.mark_keys_as_published()
+
+        bob_olm.create_session(one_time, alice_device.curve25519)
+
+        _, to_device = bob_olm.share_group_session(
+            TEST_ROOM_ID, [client.user_id], ignore_unverified_devices=True
+        )
+        bob_olm.outbound_group_sessions[TEST_ROOM_ID].shared = True
+
+        sync_response = self.empty_sync
+        sync_response["to_device"]["events"].append(
+            {
+                "sender": bob_olm.user_id,
+                "type": "m.room.encrypted",
+                "content": to_device["messages"][client.user_id][client.device_id],
+            }
+        )
+        client.handle_to_device_from_sync_body(sync_response)
+
+        return bob_olm
+
+    def _encrypted_event(self, bob_olm, body, event_id):
+        return {
+            "type": "m.room.encrypted",
+            "event_id": event_id,
+            "room_id": TEST_ROOM_ID,
+            "sender": bob_olm.user_id,
+            "origin_server_ts": 1516362244026,
+            "content": bob_olm.group_encrypt(
+                TEST_ROOM_ID,
+                {
+                    "type": "m.room.message",
+                    "content": {"msgtype": "m.text", "body": body},
+                },
+            ),
+        }
+
+    async def test_decryption_pool(self, client):
+        bob_olm = await self._receive_room_key(client)
+        client.decryption_pool = ThreadPoolExecutor(max_workers=1)
+
+        messages = {
+            "chunk": [
+                self._encrypted_event(bob_olm, f"Message {i}", f"$event{i}")
+                for i in range(10)
+            ],
+            "start": "t1",
+            "end": "t2",
+        }
+
+        await client.decrypt_messages_body(messages)
+
+        for i, event in enumerate(messages["chunk"]):
+            assert event["type"] == "m.room.message"
+            assert event["decrypted"]
+            assert event["content"]["body"] == f"Message {i}"
+
+        client.decryption_pool.shutdown()
+
+    async def test_decrypted_event_cache(self, client, monkeypatch):
+        bob_olm = await self._receive_room_key(client)
+
+        event = self._encrypted_event(bob_olm, "Hello", "$event1")
+        second_copy = deepcopy(event)
+        tampered_copy = deepcopy(event)
+
+        assert client.pan_decrypt_event(event)
+        assert len(client.decrypted_events) == 1
+
+        def decrypt(*_):
+            raise AssertionError("The cached plaintext wasn't used")
+
+        monkeypatch.setattr(InboundGroupSession, "decrypt", decrypt)
+
+        await client.decrypt_messages_body({"chunk": [second_copy]})
+
+        assert second_copy["decrypted"]
+        assert second_copy["content"]["body"] == "Hello"
+
+        monkeypatch.undo()
+
+        # A changed ciphertext isn't answered from the cache.
+        tampered_copy["content"]["ciphertext"] = "invalid"
+        await client.decrypt_messages_body({"chunk": [tampered_copy]})
+
+        assert "decrypted" not in tampered_copy
+        assert tampered_copy["content"]["body"] != "Hello"
+
+    async def test_wait_for_room_keys(self, client):
+        sessions = {(TEST_ROOM_ID, "SESSIONID")}
+
+        assert not await client.wait_for_room_keys(sessions, 0.01)
+        assert not client.room_key_waiters
+
+        waiter = asyncio.ensure_future(client.wait_for_room_keys(sessions, 5))
+        await asyncio.sleep(0)
+
+        client.room_key_received(TEST_ROOM_ID, "SESSIONID")
+
+        assert await waiter
+        assert not client.room_key_waiters
+
+    async def test_undecrypted_sessions(self, client):
+        bob_olm = await self._receive_room_key(client)
+        session_id = bob_olm.outbound_group_sessions[TEST_ROOM_ID].id
+
+        body = {"chunk": [self._encrypted_event(bob_olm, "Hello", "$1")]}
+        assert client.undecrypted_sessions(body, sync=False) == {
+            (TEST_ROOM_ID, session_id)
+        }
+
+        await client.decrypt_messages_body(body)
+        assert not client.undecrypted_sessions(body, sync=False)
+
+    async def test_to_device_deduplication(self, client, monkeypatch):
+        await client.receive_response(self.login_response)
+
+        handled = []
+        monkeypatch.setattr(client.olm, "handle_to_device_event", handled.append)
+
+        sync_response = self.empty_sync
+        sync_response["to_device"]["events"].append(
+            {
+                "sender": "@bob:example.org",
+                "type": "m.room.encrypted",
+                "content": {
+                    "algorithm": "m.olm.v1.curve25519-aes-sha2",
+                    "sender_key": "IlRMeOPX2e0MurIyfWEucYBRVOEEUMrOHqn/8mLqMjA",
+                    "ciphertext": {"KEY": {"type": 0, "body": "ciphertext"}},
+                },
+            }
+        )
+
+        # The event arrives on the sync stream of a client and on the one of
+        # the background sync client.
+        client.handle_to_device_from_sync_body(sync_response)
+        client.handle_to_device_from_sync_body(sync_response)
+        await client.receive_response(SyncResponse.from_dict(sync_response))
+
+        assert len(handled) == 1
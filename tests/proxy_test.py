@@ -1,12 +1,21 @@
 import asyncio
 import json
+import os
 import re
+import threading
 from collections import defaultdict
 
-from aiohttp import web
-from nio.crypto import OlmDevice
+import pytest
+from aiohttp import ClientPayloadError, web
+from aioresponses import CallbackResult
+from nio import EncryptionError
+from nio.crypto import OlmDevice, decrypt_attachment, encrypt_attachment
 
 from conftest import faker
+from pantalaimon.client import SyncStream
+from pantalaimon.daemon import ProxyDaemon
+from pantalaimon.media import MediaCache
+from pantalaimon.store import MediaInfo
 from pantalaimon.thread_messages import UpdateDevicesMessage, UpdateUsersMessage
 
 BOB_ID = "@bob:example.org"
@@ -208,3 +217,669 @@ class TestClass(object):
         assert isinstance(message, UpdateDevicesMessage)
 
         assert BOB_DEVICE in message.devices[BOB_ID]
+
+    async def test_router_streams_response(self, running_proxy, aioresponse):
+        _, aioclient, _, _ = running_proxy
+
+        state_url = re.compile(
+            r"^https://example\.org/_matrix/client/r0/rooms/.*/state"
+        )
+        state = [{"type": "m.room.name", "content": {"name": "x" * 200000}}]
+
+        aioresponse.get(state_url, status=200, payload=state)
+
+        resp = await aioclient.get(
+            "/_matrix/client/r0/rooms/!test:example.org/state",
+            headers={"Authorization": "Bearer abc123"},
+        )
+
+        assert resp.status == 200
+        assert resp.content_type == "application/json"
+        assert resp.headers["Access-Control-Allow-Origin"] == "*"
+        assert await resp.json() == state
+
+    async def test_router_relays_headers(self, running_proxy, aioresponse):
+        _, aioclient, _, _ = running_proxy
+
+        aioresponse.get(
+            re.compile(r"^https://example\.org/_matrix/media/r0/download/.*"),
+            status=200,
+            body=b"plaintext media",
+            content_type="text/plain",
+            headers={
+                "Content-Disposition": 'inline; filename="cat.txt"',
+                "Cache-Control": "public, max-age=86400",
+                "ETag": '"abc"',
+                "Last-Modified": "Wed, 21 Oct 2015 07:28:00 GMT",
+                "Keep-Alive": "timeout=5",
+                "Content-Encoding": "identity",
+            },
+        )
+
+        resp = await aioclient.get(
+            "/_matrix/media/r0/download/example.org/plain",
+            headers={"Authorization": "Bearer abc123"},
+        )
+
+        assert resp.status == 200
+        assert resp.headers["Content-Disposition"] == 'inline; filename="cat.txt"'
+        assert resp.headers["Cache-Control"] == "public, max-age=86400"
+        assert resp.headers["ETag"] == '"abc"'
+        assert resp.headers["Last-Modified"] == "Wed, 21 Oct 2015 07:28:00 GMT"
+        assert resp.headers["Access-Control-Allow-Origin"] == "*"
+        assert "Keep-Alive" not in resp.headers
+        assert "Content-Encoding" not in resp.headers
+        assert await resp.read() == b"plaintext media"
+
+    async def test_proxied_sync(self, running_proxy, aioresponse):
+        _, aioclient, _, _ = running_proxy
+
+        # Bodies without encrypted events are passed through as they are.
+        body = json.dumps(self.sync_response, indent=4)
+
+        sync_url = re.compile(r"^https://example\.org/_matrix/client/r0/sync")
+        aioresponse.get(
+            sync_url,
+            status=200,
+            body=body,
+            content_type="application/json",
+            repeat=True,
+        )
+
+        resp = await aioclient.get(
+            "/_matrix/client/r0/sync",
+            headers={"Authorization": "Bearer abc123"},
+        )
+
+        assert resp.status == 200
+        assert resp.headers["Access-Control-Allow-Origin"] == "*"
+        assert await resp.text() == body
+
+    async def test_proxied_encrypted_sync(self, running_proxy, aioresponse):
+        _, aioclient, proxy, _ = running_proxy
+        proxy.decryption_timeout = 0.1
+
+        sync_response = self.sync_response
+        room = sync_response["rooms"]["join"]["!SVkFJHzfwvuaIEawgC:localhost"]
+        room["timeline"]["events"].append(
+            {
+                "content": {
+                    "algorithm": "m.megolm.v1.aes-sha2",
+                    "ciphertext": "AwgAEnACgAkLmt6qF84IK++J7UDH2Za1YVchHyprqTqsg",
+                    "device_id": "RJYKSTBOIE",
+                    "sender_key": "IlRMeOPX2e0MurIyfWEucYBRVOEEUMrOHqn/8mLqMjA",
+                    "session_id": "X3lUlvLELLYxeTx4yOVu6UDpasGEVO0Jbu+QFnm0cKQ",
+                },
+                "event_id": "$143273582443PhrSn:example.org",
+                "origin_server_ts": 1432735824653,
+                "room_id": "!SVkFJHzfwvuaIEawgC:localhost",
+                "sender": "@example:example.org",
+                "type": "m.room.encrypted",
+                "unsigned": {"age": 1234},
+            }
+        )
+
+        sync_url = re.compile(r"^https://example\.org/_matrix/client/r0/sync")
+        aioresponse.get(sync_url, status=200, payload=sync_response, repeat=True)
+
+        resp = await aioclient.get(
+            "/_matrix/client/r0/sync",
+            headers={"Authorization": "Bearer abc123"},
+        )
+
+        assert resp.status == 200
+        assert resp.headers["Access-Control-Allow-Origin"] == "*"
+
+        body = await resp.json()
+        events = body["rooms"]["join"]["!SVkFJHzfwvuaIEawgC:localhost"]["timeline"]
+        assert events["events"][-1]["event_id"] == "$143273582443PhrSn:example.org"
+
+    async def test_shared_sync(self, running_proxy, aioresponse):
+        _, aioclient, proxy, _ = running_proxy
+
+        pan_client = list(proxy.pan_clients.values())[0]
+        pan_client.sync_stream = SyncStream()
+
+        body = json.dumps(self.sync_response).encode()
+        pan_client.sync_stream.add("s1", "s2", body)
+
+        resp = await aioclient.get(
+            "/_matrix/client/r0/sync",
+            params={"since": "s1"},
+            headers={"Authorization": "Bearer abc123"},
+        )
+        assert resp.status == 200
+        assert await resp.read() == body
+
+        # The request for the current token waits for the next response.
+        loop = asyncio.get_event_loop()
+        loop.call_later(0.1, pan_client.sync_stream.add, "s2", "s3", body)
+
+        resp = await aioclient.get(
+            "/_matrix/client/r0/sync",
+            params={"since": "s2", "timeout": "5000"},
+            headers={"Authorization": "Bearer abc123"},
+        )
+        assert resp.status == 200
+        assert await resp.read() == body
+
+        resp = await aioclient.get(
+            "/_matrix/client/r0/sync",
+            params={"since": "s3", "timeout": "100"},
+            headers={"Authorization": "Bearer abc123"},
+        )
+        assert resp.status == 200
+        assert await resp.json() == {"next_batch": "s3"}
+
+        # The sync loop stalled, the next request goes to the homeserver.
+        sync_url = re.compile(r"^https://example\.org/_matrix/client/r0/sync")
+        aioresponse.get(sync_url, status=200, payload={"next_batch": "s4"})
+
+        resp = await aioclient.get(
+            "/_matrix/client/r0/sync",
+            params={"since": "s3", "timeout": "100"},
+            headers={"Authorization": "Bearer abc123"},
+        )
+        assert resp.status == 200
+        assert await resp.json() == {"next_batch": "s4"}
+
+    async def test_room_key_during_decryption(self, running_proxy, monkeypatch):
+        _, _, proxy, _ = running_proxy
+        proxy.decryption_timeout = 5
+
+        client = list(proxy.pan_clients.values())[0]
+        room_id = "!SVkFJHzfwvuaIEawgC:localhost"
+        body = {
+            "rooms": {
+                "join": {
+                    room_id: {
+                        "timeline": {
+                            "events": [
+                                {
+                                    "type": "m.room.encrypted",
+                                    "content": {"session_id": "SESSIONID"},
+                                }
+                            ]
+                        }
+                    }
+                }
+            }
+        }
+        attempts = []
+
+        async def decrypt_sync_body(body, ignore_failures=True, to_device=True):
+            attempts.append(ignore_failures)
+
+            if len(attempts) == 1:
+                # The key arrives while the first attempt is still running.
+                await asyncio.sleep(0)
+                client.room_key_received(room_id, "SESSIONID")
+                raise EncryptionError("Missing room key")
+
+            return body
+
+        monkeypatch.setattr(client, "decrypt_sync_body", decrypt_sync_body)
+
+        await asyncio.wait_for(proxy.decrypt_body(client, body), 1)
+
+        assert attempts == [False, False]
+        assert not client.room_key_waiters
+
+    async def test_router_streams_request_body(self, running_proxy, aioresponse):
+        _, aioclient, _, _ = running_proxy
+
+        account_data_url = re.compile(
+            r"^https://example\.org/_matrix/client/r0/user/.*/account_data/.*"
+        )
+        content = {"data": "x" * 200000}
+        received = []
+
+        async def callback(url, **kwargs):
+            received.append(await kwargs["data"].read())
+            return CallbackResult(status=200, payload={})
+
+        aioresponse.put(account_data_url, callback=callback)
+
+        resp = await aioclient.put(
+            "/_matrix/client/r0/user/@example:example.org/account_data/m.test",
+            headers={"Authorization": "Bearer abc123"},
+            json=content,
+        )
+
+        assert resp.status == 200
+        assert json.loads(received[0]) == content
+
+    async def test_token_lookup_coalescing(self, running_proxy, aioresponse):
+        _, _, proxy, _ = running_proxy
+
+        whoami_url = re.compile(
+            r"^https://example\.org/_matrix/client/r0/account/whoami.*"
+        )
+
+        # Only a single whoami response is available, further requests would
+        # fail.
+        aioresponse.get(
+            whoami_url, status=200, payload={"user_id": "@example:example.org"}
+        )
+
+        clients = await asyncio.gather(
+            *(proxy._find_client("new_token") for _ in range(5))
+        )
+
+        pan_client = proxy.pan_clients["@example:example.org"]
+        assert all(client is pan_client for client in clients)
+
+    async def test_invalid_token_caching(self, running_proxy, aioresponse):
+        _, _, proxy, _ = running_proxy
+
+        whoami_url = re.compile(
+            r"^https://example\.org/_matrix/client/r0/account/whoami.*"
+        )
+
+        aioresponse.get(
+            whoami_url,
+            status=401,
+            payload={"errcode": "M_UNKNOWN_TOKEN", "error": "Unknown token"},
+        )
+        aioresponse.get(
+            whoami_url, status=200, payload={"user_id": "@example:example.org"}
+        )
+
+        assert not await proxy._find_client("invalid_token")
+        # The rejection is remembered, the homeserver isn't asked again.
+        assert not await proxy._find_client("invalid_token")
+
+    async def test_client_restore(self, running_proxy, tempdir):
+        _, _, proxy, _ = running_proxy
+        user_id = "@example:example.org"
+
+        restored_proxy = ProxyDaemon(
+            proxy.name,
+            proxy.homeserver,
+            proxy.conf,
+            tempdir,
+            send_queue=None,
+            recv_queue=None,
+            ssl=False,
+            client_store_class=proxy.client_store_class,
+        )
+
+        # The client isn't restored yet but requests for it wait for it.
+        assert user_id in restored_proxy.client_ready
+        assert user_id not in restored_proxy.pan_clients
+
+        client = await restored_proxy._wait_for_client(user_id)
+        assert client.user_id == user_id
+        assert client.access_token == "abc123"
+        assert not restored_proxy.client_ready
+
+        await restored_proxy.restore_task
+        await restored_proxy.shutdown(None)
+
+    async def test_media_during_client_restore(
+        self, running_proxy, aioresponse, aiohttp_client, tempdir, monkeypatch
+    ):
+        _, _, proxy, _ = running_proxy
+
+        # Hold the restore back until the requests are waiting.
+        restore_started = threading.Event()
+        load_access_token = ProxyDaemon._load_access_token
+
+        def blocked_load_access_token(self, user_id, device_id):
+            restore_started.wait(5)
+            return load_access_token(self, user_id, device_id)
+
+        monkeypatch.setattr(
+            ProxyDaemon, "_load_access_token", blocked_load_access_token
+        )
+
+        restored_proxy = ProxyDaemon(
+            proxy.name,
+            proxy.homeserver,
+            proxy.conf,
+            tempdir,
+            send_queue=None,
+            recv_queue=None,
+            ssl=False,
+            client_store_class=proxy.client_store_class,
+        )
+
+        app = web.Application()
+        app.add_routes(
+            [
+                web.get(
+                    "/_matrix/media/r0/download/{server_name}/{media_id}",
+                    restored_proxy.download,
+                ),
+                web.post("/_matrix/media/r0/upload", restored_proxy.upload),
+            ]
+        )
+        aioclient = await aiohttp_client(app)
+
+        plaintext = bytes(range(256)) * 16
+        ciphertext, keys = encrypt_attachment(plaintext)
+
+        restored_proxy.media_info[("example.org", "encrypted")] = MediaInfo(
+            "example.org", "encrypted", keys["key"], keys["iv"], keys["hashes"]
+        )
+
+        aioresponse.get(
+            re.compile(r"^https://example\.org/_matrix/media/r0/download/.*"),
+            status=200,
+            body=ciphertext,
+            content_type="image/png",
+        )
+        aioresponse.post(
+            re.compile(r"^https://example\.org/_matrix/media/r0/upload.*"),
+            status=200,
+            payload={"content_uri": "mxc://example.org/uploaded"},
+        )
+
+        download = asyncio.ensure_future(
+            aioclient.get(
+                "/_matrix/media/r0/download/example.org/encrypted",
+                headers={"Authorization": "Bearer abc123"},
+            )
+        )
+        upload = asyncio.ensure_future(
+            aioclient.post(
+                "/_matrix/media/r0/upload?filename=cat.png",
+                headers={"Authorization": "Bearer abc123"},
+                data=plaintext,
+            )
+        )
+
+        await asyncio.sleep(0.1)
+        assert not restored_proxy.pan_clients
+        restore_started.set()
+
+        resp = await download
+        assert resp.status == 200
+        assert await resp.read() == plaintext
+
+        resp = await upload
+        assert resp.status == 200
+        assert (await resp.json())["content_uri"] == "mxc://example.org/uploaded"
+
+        await restored_proxy.shutdown(None)
+
+    async def test_token_revalidation_failure(self, running_proxy, aioresponse):
+        _, _, proxy, _ = running_proxy
+
+        whoami_url = re.compile(
+            r"^https://example\.org/_matrix/client/r0/account/whoami.*"
+        )
+        pan_client = proxy.pan_clients["@example:example.org"]
+
+        # The token of the login expired from the cache and the homeserver
+        # has a hiccup while it's revalidated.
+        proxy.client_info.clear()
+        aioresponse.get(whoami_url, status=502)
+
+        assert await proxy._find_client("abc123") is pan_client
+
+        # Only a rejection of the token drops it.
+        proxy.client_info.clear()
+        aioresponse.get(
+            whoami_url,
+            status=401,
+            payload={"errcode": "M_UNKNOWN_TOKEN", "error": "Unknown token"},
+        )
+
+        assert not await proxy._find_client("abc123")
+
+    async def test_media_download(self, running_proxy, aioresponse):
+        _, aioclient, proxy, _ = running_proxy
+
+        plaintext = bytes(range(256)) * 4096
+        ciphertext, keys = encrypt_attachment(plaintext)
+
+        proxy.media_info[("example.org", "encrypted")] = MediaInfo(
+            "example.org", "encrypted", keys["key"], keys["iv"], keys["hashes"]
+        )
+
+        aioresponse.get(
+            re.compile(r"^https://example\.org/_matrix/media/r0/download/.*"),
+            status=200,
+            body=ciphertext,
+            content_type="image/png",
+        )
+
+        resp = await aioclient.get(
+            "/_matrix/media/r0/download/example.org/encrypted",
+            headers={"Authorization": "Bearer abc123"},
+        )
+
+        assert resp.status == 200
+        assert await resp.read() == plaintext
+
+    async def test_media_upload(self, running_proxy, aioresponse):
+        _, aioclient, proxy, _ = running_proxy
+
+        plaintext = bytes(range(256)) * 4096
+        uploaded = []
+
+        async def upload_callback(url, **kwargs):
+            assert kwargs["headers"]["Content-Length"] == str(len(plaintext))
+            uploaded.append(b"".join([chunk async for chunk in kwargs["data"]]))
+            return CallbackResult(
+                status=200, payload={"content_uri": "mxc://example.org/uploaded"}
+            )
+
+        aioresponse.post(
+            re.compile(r"^https://example\.org/_matrix/media/r0/upload.*"),
+            callback=upload_callback,
+        )
+
+        resp = await aioclient.post(
+            "/_matrix/media/r0/upload?filename=cat.png",
+            headers={"Authorization": "Bearer abc123", "Content-Type": "image/png"},
+            data=plaintext,
+        )
+
+        assert resp.status == 200
+        assert (await resp.json())["content_uri"] == "mxc://example.org/uploaded"
+
+        ciphertext = uploaded[0]
+        assert ciphertext != plaintext
+
+        media_info = proxy.store.load_media(proxy.name, "example.org", "uploaded")
+        assert decrypt_attachment(
+            ciphertext,
+            media_info.key["k"],
+            media_info.hashes["sha256"],
+            media_info.iv,
+        ) == plaintext
+
+    async def test_media_hash_mismatch(self, running_proxy, aioresponse):
+        _, aioclient, proxy, _ = running_proxy
+
+        plaintext = bytes(range(256)) * 1024
+        ciphertext, keys = encrypt_attachment(plaintext)
+        ciphertext = ciphertext[:-1] + bytes([ciphertext[-1] ^ 1])
+
+        proxy.media_info[("example.org", "tampered")] = MediaInfo(
+            "example.org", "tampered", keys["key"], keys["iv"], keys["hashes"]
+        )
+
+        aioresponse.get(
+            re.compile(r"^https://example\.org/_matrix/media/r0/download/.*"),
+            status=200,
+            body=ciphertext,
+            content_type="image/png",
+        )
+
+        resp = await aioclient.get(
+            "/_matrix/media/r0/download/example.org/tampered",
+            headers={"Authorization": "Bearer abc123"},
+        )
+
+        assert resp.status == 200
+
+        # The response is cut off before the last chunk.
+        with pytest.raises(ClientPayloadError):
+            await resp.read()
+
+    @pytest.mark.parametrize("encrypted", [True, False])
+    async def test_media_cache(self, running_proxy, aioresponse, tempdir, encrypted):
+        _, aioclient, proxy, _ = running_proxy
+
+        proxy.media_cache = MediaCache(
+            os.path.join(tempdir, "media"), 1024 * 1024, encrypted
+        )
+
+        plaintext = b"cached media" * 100
+        ciphertext, keys = encrypt_attachment(plaintext)
+
+        proxy.media_info[("example.org", "cached")] = MediaInfo(
+            "example.org", "cached", keys["key"], keys["iv"], keys["hashes"]
+        )
+
+        downloads = []
+
+        def callback(url, **kwargs):
+            downloads.append(url)
+            return CallbackResult(
+                status=200, body=ciphertext, content_type="image/png"
+            )
+
+        aioresponse.get(
+            re.compile(r"^https://example\.org/_matrix/media/r0/download/.*"),
+            callback=callback,
+            repeat=True,
+        )
+
+        for _ in range(2):
+            resp = await aioclient.get(
+                "/_matrix/media/r0/download/example.org/cached",
+                headers={"Authorization": "Bearer abc123"},
+            )
+
+            assert resp.status == 200
+            assert resp.content_type == "image/png"
+            assert await resp.read() == plaintext
+
+        # The second request was served from the cache.
+        assert len(downloads) == 1
+        assert len(proxy.media_cache.entries) == 1
+
+    def test_media_cache_eviction(self, tempdir):
+        cache_dir = os.path.join(tempdir, "media")
+        cache = MediaCache(cache_dir, 250, encrypted=False)
+
+        media = [
+            MediaInfo("example.org", f"media{i}", {}, "", {"sha256": f"hash{i}"})
+            for i in range(3)
+        ]
+
+        cache.store(media[0], b"", b"a" * 100, "image/png")
+        cache.store(media[1], b"", b"b" * 100, "image/png")
+        assert cache.lookup(media[0])
+
+        cache.store(media[2], b"", b"c" * 100, "image/png")
+
+        assert cache.lookup(media[0])
+        assert not cache.lookup(media[1])
+        assert cache.lookup(media[2]).read() == b"c" * 100
+
+        reloaded = MediaCache(cache_dir, 250, encrypted=False)
+        assert reloaded.size == 200
+        assert reloaded.lookup(media[2]).read() == b"c" * 100
+
+    async def test_media_range_request(self, running_proxy, aioresponse):
+        _, aioclient, proxy, _ = running_proxy
+
+        plaintext = bytes(range(256)) * 64
+        ciphertext, keys = encrypt_attachment(plaintext)
+
+        proxy.media_info[("example.org", "video")] = MediaInfo(
+            "example.org", "video", keys["key"], keys["iv"], keys["hashes"]
+        )
+
+        def callback(url, headers, **kwargs):
+            assert headers["Range"] == "bytes=1000-2999"
+            return CallbackResult(
+                status=206,
+                body=ciphertext[1000:3000],
+                content_type="video/mp4",
+                headers={"Content-Range": f"bytes 1000-2999/{len(ciphertext)}"},
+            )
+
+        aioresponse.get(
+            re.compile(r"^https://example\.org/_matrix/media/r0/download/.*"),
+            callback=callback,
+        )
+
+        resp = await aioclient.get(
+            "/_matrix/media/r0/download/example.org/video",
+            headers={"Authorization": "Bearer abc123", "Range": "bytes=1000-2999"},
+        )
+
+        assert resp.status == 206
+        assert resp.headers["Content-Range"] == f"bytes 1000-2999/{len(plaintext)}"
+        assert await resp.read() == plaintext[1000:3000]
+
+    async def test_media_cache_range_request(
+        self, running_proxy, aioresponse, tempdir
+    ):
+        _, aioclient, proxy, _ = running_proxy
+
+        proxy.media_cache = MediaCache(os.path.join(tempdir, "media"), 1024 * 1024)
+
+        plaintext = bytes(range(256)) * 64
+        ciphertext, keys = encrypt_attachment(plaintext)
+
+        media_info = MediaInfo(
+            "example.org", "video", keys["key"], keys["iv"], keys["hashes"]
+        )
+        proxy.media_info[("example.org", "video")] = media_info
+        proxy.media_cache.store(media_info, ciphertext, plaintext, "video/mp4")
+
+        for requested, expected in (
+            ("bytes=17-4112", slice(17, 4113)),
+            ("bytes=16000-", slice(16000, None)),
+            ("bytes=-100", slice(-100, None)),
+        ):
+            resp = await aioclient.get(
+                "/_matrix/media/r0/download/example.org/video",
+                headers={"Authorization": "Bearer abc123", "Range": requested},
+            )
+
+            assert resp.status == 206
+            assert await resp.read() == plaintext[expected]
+
+        resp = await aioclient.get(
+            "/_matrix/media/r0/download/example.org/video",
+            headers={"Authorization": "Bearer abc123", "Range": "bytes=20000-"},
+        )
+
+        assert resp.status == 416
+
+    async def test_media_cache_hash_mismatch(self, running_proxy, tempdir):
+        _, aioclient, proxy, _ = running_proxy
+
+        proxy.media_cache = MediaCache(os.path.join(tempdir, "media"), 1024 * 1024)
+
+        plaintext = bytes(range(256)) * 64
+        ciphertext, keys = encrypt_attachment(plaintext)
+        tampered = ciphertext[:-1] + bytes([ciphertext[-1] ^ 1])
+
+        media_info = MediaInfo(
+            "example.org", "video", keys["key"], keys["iv"], keys["hashes"]
+        )
+        proxy.media_info[("example.org", "video")] = media_info
+        proxy.media_cache.store(media_info, tampered, plaintext, "video/mp4")
+
+        resp = await aioclient.get(
+            "/_matrix/media/r0/download/example.org/video",
+            headers={"Authorization": "Bearer abc123"},
+        )
+
+        assert resp.status == 200
+
+        # The response is cut off before the last chunk.
+        with pytest.raises(ClientPayloadError):
+            await resp.read()
+
+        assert not proxy.media_cache.entries
+        assert not os.listdir(proxy.media_cache.path)
@@ -8,7 +8,19 @@ from nio import RoomMessage, RoomEncryptedMedia
 from urllib.parse import urlparse
 from conftest import faker
 from pantalaimon.index import INDEXING_ENABLED
-from pantalaimon.store import FetchTask, MediaInfo, UploadInfo
+from nio.crypto import InboundGroupSession, OlmAccount, OutboundGroupSession
+from nio.store import SqliteStore
+
+from pantalaimon.store import (
+    FetchTask,
+    KeyDroppingSqliteStore,
+    MediaInfo,
+    PanStore,
+    ReadThroughCache,
+    UploadInfo,
+    lazy_session_store_class,
+    profiled_store_class,
+)
 
 TEST_ROOM = "!SVkFJHzfwvuaIEawgC:localhost"
 TEST_ROOM2 = "!testroom:localhost"
@@ -102,6 +114,104 @@ class TestClass(object):
 
         assert panstore.load_token("example", user) == "abc123"
 
+    async def test_async_store(self, panstore_with_users):
+        panstore = panstore_with_users
+        accounts = panstore.load_all_users()
+        user, _ = accounts[0]
+        task = FetchTask(TEST_ROOM, "abc")
+
+        await panstore.aio.save_fetcher_task("example", user, task)
+        assert await panstore.aio.load_fetcher_tasks("example", user) == [task]
+
+        await panstore.aio.delete_fetcher_task("example", user, task)
+        assert not panstore.load_fetcher_tasks("example", user)
+
+        panstore.close()
+
+    async def test_read_through_cache(self, panstore):
+        server_name = "test"
+        event = self.encrypted_media_event
+        assert not panstore.load_media_cache(server_name)
+
+        for path in ("old", "new"):
+            media = MediaInfo("localhost", path, event.key, event.iv, event.hashes)
+            panstore.save_media(server_name, media)
+
+        # The most recent entries are loaded last.
+        assert list(panstore.load_media_cache(server_name)) == [
+            ("localhost", "old"),
+            ("localhost", "new"),
+        ]
+
+        cache = ReadThroughCache(
+            1, lambda key: panstore.aio.load_media(server_name, *key)
+        )
+
+        assert (await cache.get(("localhost", "old"))).mxc_path == "old"
+        assert (await cache.get(("localhost", "old"))).mxc_path == "old"
+        assert not await cache.get(("localhost", "missing"))
+        assert (cache.hits, cache.misses) == (1, 2)
+
+        assert (await cache.get(("localhost", "new"))).mxc_path == "new"
+        assert ("localhost", "old") not in cache
+
+        panstore.close()
+
+    def test_row_id_cache(self, panstore_with_users, tempdir):
+        panstore = panstore_with_users
+        accounts = panstore.load_all_users()
+        user, _ = accounts[0]
+
+        assert ("example", user) in panstore.server_user_ids
+
+        other_store = PanStore(tempdir, "pan.db")
+        assert other_store.server_ids == panstore.server_ids
+        assert other_store.server_user_ids == panstore.server_user_ids
+
+        other_store.save_fetcher_task("example", user, FetchTask(TEST_ROOM, "abc"))
+        assert panstore.load_fetcher_tasks("example", user) == [
+            FetchTask(TEST_ROOM, "abc")
+        ]
+
+    def test_write_behind(self, panstore_with_users, tempdir):
+        panstore = panstore_with_users
+        accounts = panstore.load_all_users()
+        user, _ = accounts[0]
+
+        # Make sure the writer thread doesn't flush on its own.
+        panstore.flush_interval = 60
+
+        event = self.encrypted_media_event
+        media = MediaInfo("localhost", "media", event.key, event.iv, event.hashes)
+
+        panstore.save_token("example", user, "abc123")
+        panstore.save_token("example", user, "abc124")
+        panstore.save_media("example", media)
+
+        # Queued writes are visible to the store that queued them.
+        assert panstore.load_token("example", user) == "abc124"
+        assert panstore.load_media("example", "localhost", "media") == media
+
+        other_store = PanStore(tempdir, "pan.db")
+        assert not other_store.load_token("example", user)
+        assert not other_store.load_media("example", "localhost", "media")
+
+        panstore.close()
+
+        assert not panstore.pending_tokens
+        assert not panstore.pending_media
+        assert other_store.load_token("example", user) == "abc124"
+        assert other_store.load_media("example", "localhost", "media") == media
+
+    def test_write_behind_unknown_server(self, panstore):
+        event = self.encrypted_media_event
+        media = MediaInfo("localhost", "media", event.key, event.iv, event.hashes)
+
+        panstore.save_media("unknown", media)
+        panstore.flush()
+
+        assert not panstore.pending_media
+
     def test_fetcher_tasks(self, panstore_with_users):
         panstore = panstore_with_users
         accounts = panstore.load_all_users()
@@ -199,3 +309,99 @@ class TestClass(object):
         upload_info = upload_cache[event.url]
         assert upload_info == upload
         assert upload_info == panstore.load_upload(server_name, event.url)
+
+    def test_decrypted_upload_storage(self, panstore):
+        server_name = "test"
+        assert not panstore.load_decrypted_uploads(server_name)
+
+        event = self.encrypted_media_event
+        decrypted_uri = "mxc://localhost/plaintextCopy"
+
+        assert not panstore.load_decrypted_uploads(server_name, event.url)
+
+        panstore.save_decrypted_upload(server_name, event.url, decrypted_uri)
+
+        decrypted_uploads = panstore.load_decrypted_uploads(server_name)
+        assert decrypted_uploads[event.url] == decrypted_uri
+        assert panstore.load_decrypted_uploads(server_name, event.url) == decrypted_uri
+
+    def test_storage_profile(self, tempdir):
+        store = PanStore(tempdir, storage_profile="wal")
+        assert store.database.journal_mode == "wal"
+        assert store.database.synchronous == 1
+
+        store_class = profiled_store_class(SqliteStore, "wal")
+        assert issubclass(store_class, SqliteStore)
+
+        client_store = store_class(faker.mx_id(), faker.device_id(), tempdir)
+        assert client_store.database.journal_mode == "wal"
+
+        store = PanStore(tempdir, "default.db")
+        assert store.database.journal_mode == "delete"
+
+    def test_lazy_group_session_store(self, tempdir):
+        user_id = faker.mx_id()
+        device_id = faker.device_id()
+        store_class = lazy_session_store_class(SqliteStore, 10)
+
+        store = store_class(user_id, device_id, tempdir)
+        account = OlmAccount()
+        store.save_account(account)
+
+        outbound = OutboundGroupSession()
+        session = InboundGroupSession(
+            outbound.session_key,
+            account.identity_keys["ed25519"],
+            account.identity_keys["curve25519"],
+            TEST_ROOM,
+        )
+        store.save_inbound_group_session(session)
+
+        store = store_class(user_id, device_id, tempdir)
+        store.load_account()
+        sessions = store.load_inbound_group_sessions()
+
+        assert not sessions.sessions
+
+        loaded = sessions.get(TEST_ROOM, session.sender_key, session.id)
+        assert loaded.id == session.id
+        assert (TEST_ROOM, session.sender_key, session.id) in sessions.sessions
+        assert not sessions.get(TEST_ROOM, session.sender_key, "unknown")
+
+        assert [s.id for s in sessions] == [session.id]
+        assert [s.id for s in sessions[TEST_ROOM][session.sender_key].values()] == [
+            session.id
+        ]
+
+    def test_batched_session_saves(self, tempdir):
+        user_id = faker.mx_id()
+        device_id = faker.device_id()
+
+        store = KeyDroppingSqliteStore(user_id, device_id, tempdir)
+        account = OlmAccount()
+        store.save_account(account)
+
+        def new_session(room_id):
+            return InboundGroupSession(
+                OutboundGroupSession().session_key,
+                account.identity_keys["ed25519"],
+                account.identity_keys["curve25519"],
+                room_id,
+            )
+
+        old_session = new_session(TEST_ROOM)
+        session = new_session(TEST_ROOM)
+        other_session = new_session(TEST_ROOM2)
+
+        store.save_inbound_group_sessions([old_session, session])
+
+        with store.batch_session_saves():
+            store.save_inbound_group_session(other_session)
+            assert not store.load_inbound_group_sessions().get(
+                TEST_ROOM2, other_session.sender_key, other_session.id
+            )
+
+        sessions = store.load_inbound_group_sessions()
+        assert not sessions.get(TEST_ROOM, session.sender_key, old_session.id)
+        assert sessions.get(TEST_ROOM, session.sender_key, session.id)
+        assert sessions.get(TEST_ROOM2, session.sender_key, other_session.id)